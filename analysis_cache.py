@@ -0,0 +1,213 @@
+"""
+Persistent cache of the results of analysis helpers.
+
+A result is keyed by the name and source code of the function, its
+arguments, the size and modification time of its input files and the grid
+fingerprint of target-grid arguments, so that results are recomputed when a
+store is rewritten or the target grid changes. xarray results are stored as
+NetCDF (or zarr), which is read lazily, and other values are pickled next to
+them. The cache is kept under a byte budget by evicting the least recently
+used results.
+
+Processes computing the same result are serialised with a file lock, so
+that it is computed once. The locks are removed along with their results.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import typing as t
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import xarray as xr
+from dask.base import tokenize
+
+from cdo_cache import CacheStats, prune_locks, single_flight
+from utils import grid_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def _source_hash(func: t.Callable) -> str:
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = func.__code__.co_code.hex()
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _path_stamp(path: str) -> list:
+    """
+    Size and modification time of a file, or of the top-level entries of a
+    directory (e.g. a zarr store, whose array directories change when chunks
+    are written).
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return [path, None]
+    if not os.path.isdir(path):
+        return [path, st.st_size, st.st_mtime_ns]
+    entries = sorted(
+        (e.name, e.stat().st_mtime_ns) for e in os.scandir(path) if not e.is_symlink()
+    )
+    return [path, st.st_mtime_ns, entries]
+
+
+def _size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+@dataclass
+class AnalysisCache:
+    """
+    Parameters:
+    - root: cache directory
+    - max_bytes: size budget of the cache; None disables eviction
+    - min_age: seconds a result is kept after its last use regardless of the
+      budget, so that results being read by other processes are not evicted
+    - format: "netcdf" or "zarr", for xarray results
+    """
+
+    root: str = "cache/analysis"
+    max_bytes: int | None = 20 * 2**30
+    min_age: float = 600
+    format: str = "netcdf"
+    stats: CacheStats = field(default_factory=CacheStats)
+
+    def cache(
+        self,
+        func: t.Callable | None = None,
+        *,
+        inputs: t.Sequence[str] = (),
+        grids: t.Sequence[str] = (),
+    ):
+        """
+        Decorator caching the results of ``func``.
+
+        Parameters:
+        - inputs: files or stores read by ``func``; formatted with its
+          arguments, e.g. ``"data/ap84SeasRF/{field}.zarr.zip"``
+        - grids: arguments only used for their grid, e.g. regridding targets,
+          which are keyed by their longitudes and latitudes
+        """
+        if func is None:
+            return functools.partial(self.cache, inputs=inputs, grids=grids)
+        name = f"{Path(inspect.getfile(func)).stem}.{func.__qualname__}"
+        signature = inspect.signature(func)
+        code = _source_hash(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {
+                k: grid_fingerprint(v) if k in grids else tokenize(v)
+                for k, v in bound.arguments.items()
+            }
+            stamps = [_path_stamp(p.format(**bound.arguments)) for p in inputs]
+            key = hashlib.sha256(
+                json.dumps([code, arguments, stamps], default=str).encode()
+            ).hexdigest()
+            return self.get(Path(self.root) / name / key, func, args, kwargs)
+
+        return wrapper
+
+    def get(self, path: Path, func: t.Callable, args, kwargs):
+        if self._hit(path):
+            return self._load(path)
+        with single_flight(path):
+            if self._hit(path):
+                return self._load(path)
+            self.stats.misses += 1
+            logger.info(f"Analysis cache miss, computing {path}")
+            result = func(*args, **kwargs)
+            staged = Path(f"{path}.{os.getpid()}.tmp")
+            shutil.rmtree(staged, ignore_errors=True)
+            self._dump(result, staged)
+            os.replace(staged, path)
+        self.evict()
+        return self._load(path)
+
+    def _dump(self, result, path: Path):
+        path.mkdir(parents=True)
+        items = result if isinstance(result, tuple) else (result,)
+        kinds = []
+        for i, item in enumerate(items):
+            if isinstance(item, (xr.DataArray, xr.Dataset)):
+                kind = type(item).__name__
+                if self.format == "zarr":
+                    item.to_zarr(path / f"{i}.zarr")
+                else:
+                    item.to_netcdf(path / f"{i}.nc")
+            else:
+                kind = "pickle"
+                with open(path / f"{i}.pkl", "wb") as f:
+                    pickle.dump(item, f)
+            kinds.append(kind)
+        meta = {"kinds": kinds, "tuple": isinstance(result, tuple)}
+        (path / "meta.json").write_text(json.dumps(meta))
+
+    def _load(self, path: Path):
+        meta = json.loads((path / "meta.json").read_text())
+        items = []
+        for i, kind in enumerate(meta["kinds"]):
+            if kind == "pickle":
+                with open(path / f"{i}.pkl", "rb") as f:
+                    items.append(pickle.load(f))
+                continue
+            open_ = xr.open_dataarray if kind == "DataArray" else xr.open_dataset
+            if (path / f"{i}.zarr").exists():
+                items.append(open_(path / f"{i}.zarr", engine="zarr", chunks={}))
+            else:
+                items.append(open_(path / f"{i}.nc"))
+        return tuple(items) if meta["tuple"] else items[0]
+
+    def _hit(self, path: Path) -> bool:
+        try:
+            # atime is unreliable on scratch file systems; mtime marks the use
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        self.stats.hits += 1
+        logger.debug(f"Analysis cache hit {path}")
+        return True
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for p in Path(self.root).glob("*/*"):
+            if p.suffix in (".lock", ".tmp"):
+                continue
+            try:
+                entries.append((p.stat().st_mtime, _size(p), p))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, p in sorted(entries):
+            if total <= self.max_bytes or now - mtime < self.min_age:
+                break
+            # Renamed first so that readers never see a partial entry
+            trash = p.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                os.replace(p, trash)
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            else:
+                shutil.rmtree(trash, ignore_errors=True)
+                self.stats.evicted += 1
+                self.stats.evicted_bytes += size
+            total -= size
+        prune_locks(Path(self.root).glob("*/*.lock"))
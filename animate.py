@@ -0,0 +1,165 @@
+"""
+Animations of daily statistics of a WRF output variable.
+
+    python animate.py --exp ap84SeasRF_WRF_ERA5sfc --date 20090102T0000Z T2
+    python animate.py --exp ap84SeasRF --date 20090602T0000Z --members 1 2 3 \\
+        --level 950 t
+
+Surface variables are read from ``wrf2d_<variable>.nc`` and pressure-level
+variables from ``wrf_isobaricInhPa_<variable>.grb2``, of which only the
+messages of the requested level are decoded, through the cfgrib index of the
+file. The daily statistics are cached by
+:class:`analysis_cache.AnalysisCache` under a key that includes the level,
+the time slice and the operator, and the members share one colour range.
+"""
+
+import argparse
+import hashlib
+import logging
+from pathlib import Path
+
+import colorcet as cc
+import numpy as np
+import xarray as xr
+
+from analysis_cache import AnalysisCache
+from render import Animation
+from utils import calculate_colormap_range, detect_time_dimension, get_cmap
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = "/scratch/athippp/cylc-archive"
+GRIB_INDEX_DIR = "cache/grib"
+OPERATORS = {"daymean": "mean", "daymax": "max", "daymin": "min"}
+
+memory = AnalysisCache()
+
+
+def source_path(
+    exp: str, date: str, member: int, variable: str, level: int | None = None
+) -> str:
+    outputs = f"{ARCHIVE}/{exp}/{date}/mem{member}/outputs"
+    if level is None:
+        return f"{outputs}/wrf2d_{variable}.nc"
+    return f"{outputs}/wrf_isobaricInhPa_{variable}.grb2"
+
+
+def open_source(path: str, variable: str, level: int | None = None) -> xr.DataArray:
+    """
+    ``variable`` of ``path`` along ``time``, read lazily; for GRIB files only
+    the messages on the ``level`` (hPa) pressure level.
+    """
+    if level is None:
+        dvar = xr.open_dataset(path)[variable]
+        time_dim = detect_time_dimension(dvar)
+        return dvar if time_dim == "time" else dvar.rename({time_dim: "time"})
+    # cfgrib indexes the message headers once; the index is kept in the cache
+    # as the archive may not be writable
+    key = hashlib.sha1(path.encode()).hexdigest()[:16]
+    Path(GRIB_INDEX_DIR).mkdir(parents=True, exist_ok=True)
+    ds = xr.open_dataset(
+        path,
+        engine="cfgrib",
+        backend_kwargs={
+            "indexpath": f"{GRIB_INDEX_DIR}/{key}.{{short_hash}}.idx",
+            "filter_by_keys": {
+                "typeOfLevel": "isobaricInhPa",
+                "level": level,
+                "shortName": variable,
+            },
+        },
+    )
+    # Forecast steps of one initialisation: index by valid time instead
+    dvar = ds[variable].drop_vars(["time", "isobaricInhPa"], errors="ignore")
+    dvar = dvar.swap_dims(step="valid_time").drop_vars("step")
+    return dvar.rename(valid_time="time")
+
+
+@memory.cache(inputs=["{path}"])
+def daily_stat(
+    path: str,
+    variable: str,
+    level: int | None = None,
+    operator: str = "daymean",
+    start: str | None = None,
+    end: str | None = None,
+) -> xr.DataArray:
+    """
+    Daily ``operator`` (as the CDO operator) of ``variable`` between ``start``
+    and ``end``.
+    """
+    # Chunked after opening, so that each task only reads its own days
+    dvar = open_source(path, variable, level).sel(time=slice(start, end))
+    dvar = dvar.chunk({"time": 24})
+    return getattr(dvar.resample(time="1D"), OPERATORS[operator])(keep_attrs=True)
+
+
+def animate(
+    exp: str,
+    date: str,
+    variable: str,
+    members=(1,),
+    level: int | None = None,
+    operator: str = "daymean",
+    start: str | None = None,
+    end: str | None = None,
+    output: str = ".",
+    fps: int = 10,
+    max_workers: int | None = None,
+) -> list[str]:
+    """
+    Animate the daily ``operator`` of ``variable`` for each of ``members``,
+    with one colour range, and return the paths of the videos.
+    """
+    dvars = {}
+    for mem in members:
+        path = source_path(exp, date, mem, variable, level)
+        dvar = daily_stat(path, variable, level, operator, start, end)
+        dvar = dvar.chunk({"time": 1})
+        if dvar.attrs.get("units") == "K":
+            dvar = (dvar - 273.15).assign_attrs(dvar.attrs, units="C")
+        dvars[mem] = dvar
+    vmin, vmax = calculate_colormap_range(list(dvars.values()))
+    cmap, norm = get_cmap(np.linspace(vmin, vmax, 30), cc.cm["rainbow4"])
+
+    name = variable if level is None else f"{variable}_{level}hPa"
+    where = "" if level is None else f" at {level} hPa"
+    paths = []
+    for mem, dvar in dvars.items():
+        label = dvar.attrs.get("long_name", variable)
+        out = Path(output) / f"{name}_{operator}_{exp}_{date}_mem{mem}.mp4"
+        out.parent.mkdir(parents=True, exist_ok=True)
+        Animation(
+            dvar,
+            cmap,
+            norm,
+            label=f"{label}{where} ({dvar.attrs.get('units', '')})",
+            title=f"{exp} mem{mem} {{time:%Y-%m-%d}}",
+        ).save(str(out), fps=fps, max_workers=max_workers)
+        paths.append(str(out))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("variable", help="e.g. T2, or t with --level")
+    parser.add_argument("--exp", required=True)
+    parser.add_argument(
+        "--date", required=True, help="initialisation, e.g. 20090102T0000Z"
+    )
+    parser.add_argument("--members", type=int, nargs="+", default=[1])
+    parser.add_argument("--level", type=int, help="pressure level (hPa)")
+    parser.add_argument("--operator", choices=OPERATORS, default="daymean")
+    parser.add_argument("--start", help="first day, e.g. 2009-01-15")
+    parser.add_argument("--end", help="last day")
+    parser.add_argument("--output", default=".")
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--max-workers", type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    for path in animate(**vars(args)):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
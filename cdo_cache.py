@@ -0,0 +1,192 @@
+"""
+Content-addressed cache of CDO results.
+
+A result is keyed by the CDO options and chain together with the path, size
+and modification time of every input file in the chain, so that regenerated
+inputs are never served stale results. The cache is kept under a byte budget
+by evicting the least recently used results.
+
+Concurrent workers asking for the same result are serialised with a file
+lock per key, so that CDO runs once and the others wait for its result. The
+locks are removed along with the results they guarded.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from cdo import Cdo
+
+logger = logging.getLogger(__name__)
+
+
+def input_files(chain: str) -> list[str]:
+    """
+    Paths of the existing files among the operands of a CDO chain.
+    """
+    return [
+        token
+        for token in chain.split()
+        if not token.startswith("-")
+        and token not in ("[", "]")
+        and os.path.isfile(token)
+    ]
+
+
+@contextmanager
+def single_flight(path):
+    """
+    Hold an exclusive lock on ``<path>.lock``, waiting for other holders.
+
+    Callers re-check for ``path`` once the lock is acquired, since another
+    process may have produced it in the meantime. A lock file removed by
+    :func:`prune_locks` while waiting is recreated.
+    """
+    lock = Path(f"{path}.lock")
+    lock.parent.mkdir(parents=True, exist_ok=True)
+    while True:
+        with open(lock, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if _is_current(lock, f):
+                    yield
+                    return
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_current(lock: Path, f) -> bool:
+    try:
+        return os.stat(lock).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def prune_locks(locks):
+    """
+    Remove the ``<path>.lock`` files among ``locks`` whose ``path`` does not
+    exist (any more) and that are not held.
+    """
+    for lock in locks:
+        if lock.with_suffix("").exists():
+            continue
+        try:
+            f = open(lock)
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            # Waiters that opened it meanwhile notice and recreate it
+            if _is_current(lock, f) and not lock.with_suffix("").exists():
+                lock.unlink()
+
+
+def publish(src, dest):
+    """
+    Move ``src`` to ``dest`` so that ``dest`` never appears half written.
+    """
+    staged = Path(f"{dest}.{os.getpid()}.tmp")
+    shutil.move(src, staged)
+    os.replace(staged, dest)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evicted: int = 0
+    evicted_bytes: int = 0
+
+
+@dataclass
+class CdoCache:
+    """
+    Parameters:
+    - root: cache directory
+    - max_bytes: size budget of the cache; None disables eviction
+    - tempdir: directory of the CDO temporary outputs, on the same file
+      system as ``root`` so that results are published with a rename
+    - min_age: seconds a result is kept after its last use regardless of the
+      budget, so that results being opened by other processes are not evicted
+    """
+
+    root: str = "cdo_cache"
+    max_bytes: int | None = 100 * 2**30
+    tempdir: str = "tmp"
+    min_age: float = 600
+    stats: CacheStats = field(default_factory=CacheStats)
+
+    def key(self, chain: str, options: str = "") -> str:
+        h = hashlib.sha256(f"{options}\0{chain}".encode())
+        for path in input_files(chain):
+            st = os.stat(path)
+            h.update(
+                f"\0{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode()
+            )
+        return h.hexdigest()
+
+    def get(self, chain: str, options: str = "") -> Path:
+        """
+        Path of the result of ``cdo [options] <chain>``, running CDO on a miss.
+        """
+        path = Path(self.root) / f"{self.key(chain, options)}.nc"
+        if self._hit(path):
+            return path
+        with single_flight(path):
+            if self._hit(path):
+                return path
+            self.stats.misses += 1
+            logger.info(
+                f"CDO cache miss ({self.stats.hits} hits, {self.stats.misses} misses), "
+                f"executing: cdo {options} {chain}"
+            )
+            Path(self.tempdir).mkdir(parents=True, exist_ok=True)
+            cdo = Cdo(tempdir=self.tempdir, silent=False)
+            publish(cdo.copy(input=chain, options=options), path)
+        self.evict()
+        return path
+
+    def _hit(self, path: Path) -> bool:
+        try:
+            # atime is unreliable on scratch file systems; mtime marks the use
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        self.stats.hits += 1
+        logger.debug(f"CDO cache hit {path}")
+        return True
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = []
+        for p in Path(self.root).glob("*.nc"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, p in sorted(entries):
+            if total <= self.max_bytes or now - mtime < self.min_age:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+            else:
+                self.stats.evicted += 1
+                self.stats.evicted_bytes += size
+            total -= size
+        prune_locks(Path(self.root).glob("*.nc.lock"))
@@ -0,0 +1,231 @@
+"""
+In-process evaluation of CDO operator chains with xarray.
+
+Chains such as ``-setname,precip -seltimestep,2/7 -monsum -sub
+-seltimestep,2/-1 f -seltimestep,1/-2 f`` are parsed and evaluated lazily on
+the opened datasets instead of forking ``cdo`` and re-reading its output.
+Only the operators the analysis chains use are implemented; anything else
+raises :class:`UnsupportedOperator` so that callers can fall back to CDO.
+"""
+
+import operator
+import typing as t
+from dataclasses import dataclass
+
+import numpy as np
+import xarray as xr
+
+from utils import detect_time_dimension
+
+
+class UnsupportedOperator(ValueError):
+    pass
+
+
+@dataclass
+class File:
+    path: str
+
+
+@dataclass
+class Node:
+    name: str
+    args: list[str]
+    inputs: list[t.Union["Node", File]]
+
+
+def _seltimestep(ds, *args):
+    dim = detect_time_dimension(ds)
+    n = ds.sizes[dim]
+    index = []
+    for arg in args:
+        parts = [int(p) for p in arg.split("/")]
+        first = parts[0]
+        last = parts[1] if len(parts) > 1 else first
+        inc = parts[2] if len(parts) > 2 else 1
+        first = first if first > 0 else n + first + 1
+        last = last if last > 0 else n + last + 1
+        steps = range(first - 1, last, inc)
+        if steps and (steps[0] < 0 or steps[-1] >= n):
+            # CDO fails too, rather than selecting fewer timesteps
+            raise ValueError(f"seltimestep,{arg}: {dim} has {n} timesteps")
+        index.extend(steps)
+    if index == list(range(index[0], index[-1] + 1)):
+        return ds.isel({dim: slice(index[0], index[-1] + 1)})
+    return ds.isel({dim: index})
+
+
+def _binary(op):
+    def apply(a: xr.Dataset, b: xr.Dataset):
+        # CDO pairs variables and timesteps by position and keeps the metadata
+        # of the first input; xarray would align on the time coordinate.
+        out = a.copy()
+        for va, vb in zip(a.data_vars, b.data_vars):
+            out[va] = a[va].copy(data=op(a[va].data, b[vb].data))
+        return out
+
+    return apply
+
+
+def _const(op):
+    def apply(ds, c):
+        return op(ds, float(c))
+
+    return apply
+
+
+def _resample(freq, how):
+    def apply(ds):
+        # As CDO, each interval is stamped with its last contributing
+        # timestep and intervals without timesteps are left out
+        dim = detect_time_dimension(ds)
+        out = getattr(ds.resample({dim: freq}), how)()
+        last = ds[dim].resample({dim: freq}).max()
+        out = out.assign_coords({dim: last.values})
+        return out.isel({dim: ~np.isnat(last.values)})
+
+    return apply
+
+
+def _ymon(how):
+    def apply(ds):
+        # As CDO, keep the time axis: each month is stamped with its last
+        # contributing timestep
+        dim = detect_time_dimension(ds)
+        out = getattr(ds.groupby(f"{dim}.month"), how)()
+        last = ds[dim].groupby(f"{dim}.month").max()
+        out = out.assign_coords({dim: ("month", last.values)})
+        return out.swap_dims(month=dim).drop_vars("month")
+
+    return apply
+
+
+def _ens(how):
+    def apply(*inputs):
+        ds = xr.concat(inputs, dim="ensemble", coords="minimal", compat="override")
+        ds = ds.chunk({"ensemble": -1}) if how == "median" else ds
+        return getattr(ds, how)("ensemble")
+
+    return apply
+
+
+def _setname(ds, name):
+    first = list(ds.data_vars)[0]
+    return ds.rename_vars({first: name})
+
+
+def _chname(ds, *names):
+    return ds.rename_vars(dict(zip(names[::2], names[1::2])))
+
+
+def _setattribute(ds, *specs):
+    ds = ds.copy()
+    for spec in specs:
+        target, value = spec.split("=", 1)
+        var, attr = target.split("@", 1) if "@" in target else (None, target)
+        if var is None:
+            ds.attrs[attr] = value
+        else:
+            ds[var].attrs[attr] = value
+    return ds
+
+
+def _selname(ds, *names):
+    return ds[list(names)]
+
+
+def _mergetime(*inputs):
+    return xr.concat(inputs, dim=detect_time_dimension(inputs[0]))
+
+
+# name -> (number of inputs, function); -1 takes all bracketed inputs
+OPERATORS: dict[str, tuple[int, t.Callable]] = {
+    "copy": (1, lambda ds: ds),
+    "seltimestep": (1, _seltimestep),
+    "selname": (1, _selname),
+    "selvar": (1, _selname),
+    "setname": (1, _setname),
+    "chname": (1, _chname),
+    "setattribute": (1, _setattribute),
+    "add": (2, _binary(operator.add)),
+    "sub": (2, _binary(operator.sub)),
+    "mul": (2, _binary(operator.mul)),
+    "div": (2, _binary(operator.truediv)),
+    "addc": (1, _const(operator.add)),
+    "subc": (1, _const(operator.sub)),
+    "mulc": (1, _const(operator.mul)),
+    "divc": (1, _const(operator.truediv)),
+    "daymin": (1, _resample("1D", "min")),
+    "daymax": (1, _resample("1D", "max")),
+    "daymean": (1, _resample("1D", "mean")),
+    "daysum": (1, _resample("1D", "sum")),
+    "monmin": (1, _resample("MS", "min")),
+    "monmax": (1, _resample("MS", "max")),
+    "monmean": (1, _resample("MS", "mean")),
+    "monsum": (1, _resample("MS", "sum")),
+    "ymonmean": (1, _ymon("mean")),
+    "ensmean": (-1, _ens("mean")),
+    "ensmedian": (-1, _ens("median")),
+    "ensmin": (-1, _ens("min")),
+    "ensmax": (-1, _ens("max")),
+    "ensstd": (-1, _ens("std")),
+    "mergetime": (-1, _mergetime),
+}
+
+
+def parse(chain: str) -> Node | File:
+    tokens = chain.split()
+    node = _parse(tokens)
+    if tokens:
+        raise ValueError(f"Unexpected trailing input in CDO chain: {' '.join(tokens)}")
+    return node
+
+
+def _parse(tokens: list[str]) -> Node | File:
+    token = tokens.pop(0)
+    if not token.startswith("-"):
+        return File(token)
+    name, *args = token[1:].split(",")
+    if name not in OPERATORS:
+        raise UnsupportedOperator(name)
+    arity = OPERATORS[name][0]
+    inputs = []
+    if tokens and tokens[0] == "[":
+        tokens.pop(0)
+        while tokens[0] != "]":
+            inputs.append(_parse(tokens))
+        tokens.pop(0)
+    elif arity < 0:
+        while tokens:
+            inputs.append(_parse(tokens))
+    else:
+        inputs = [_parse(tokens) for _ in range(arity)]
+    if arity >= 0 and len(inputs) != arity:
+        raise ValueError(f"-{name} takes {arity} inputs, got {len(inputs)}")
+    return Node(name, args, inputs)
+
+
+def evaluate(
+    chain: str, open_file: t.Callable[[str], xr.Dataset] | None = None
+) -> xr.Dataset:
+    """
+    Evaluate a CDO operator chain lazily.
+
+    Parameters:
+    - chain: CDO operators and input files, as passed to ``cdo``
+    - open_file: opens an input path; every path is opened once per call
+
+    Raises UnsupportedOperator for operators without a native implementation.
+    """
+    open_file = open_file or (lambda path: xr.open_dataset(path, chunks={}))
+    opened: dict[str, xr.Dataset] = {}
+
+    def _eval(node):
+        if isinstance(node, File):
+            if node.path not in opened:
+                opened[node.path] = open_file(node.path)
+            return opened[node.path]
+        func = OPERATORS[node.name][1]
+        return func(*[_eval(i) for i in node.inputs], *node.args)
+
+    return _eval(parse(chain))
@@ -0,0 +1,276 @@
+"""
+Materialised ensemble statistics and climatologies of an ingested store.
+
+For every forecast of a (forecast, member, lead, y, x) store, the ensemble
+statistics of each lead window (e.g. single months and 3-month seasons) are
+stored once in the ``ens`` group of ``<store>.clim.zarr``. Their means over
+the forecasts of each initialisation month are stored in the ``clim`` group,
+so that a seasonal figure reads one 2-D slice instead of reducing every
+member of every forecast again.
+
+:meth:`Climatology.update` only reduces forecasts that are not in the cube
+yet or whose members were re-ingested since, as recorded in the ingest
+manifest of the store, and only recomputes the climatologies of their
+initialisation months.
+"""
+
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ensemble import member_median
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Climatology:
+    """
+    Parameters:
+    - store: ingested zarr store
+    - field: variable of the store
+    - lead_dim: lead-month dimension of the store
+    - stats: ensemble statistics; "mem1" is the first member
+    - windows: lengths in months of the lead windows averaged before the
+      ensemble statistic is taken
+    - path: cube location, ``<store>.clim.zarr`` by default
+    """
+
+    store: str
+    field: str
+    lead_dim: str = "Times"
+    stats: tuple[str, ...] = ("mean", "median", "mem1")
+    windows: tuple[int, ...] = (1, 3)
+    path: str | None = None
+
+    def __post_init__(self):
+        if self.path is None:
+            self.path = (
+                f"{self.store.removesuffix('.zip').removesuffix('.zarr')}.clim.zarr"
+            )
+
+    def source(self) -> xr.DataArray:
+        source = xr.open_zarr(self.store)[self.field]
+        # Keep only the horizontal coordinates, e.g. XLAT/XLONG for plotting
+        spatial = set(source.dims) - {"forecast", "member", self.lead_dim}
+        return source.drop_vars(
+            [
+                c
+                for c in source.coords
+                if c not in source.dims and not set(source[c].dims) <= spatial
+            ]
+        )
+
+    def source_stamps(self) -> dict[pd.Timestamp, str]:
+        """
+        Fingerprint of the source files of the members of each forecast, from
+        the manifest written by :class:`ingest.ZarrIngest`.
+        """
+        path = f"{self.store.removesuffix('.zip')}.manifest.json"
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"No {path}: re-ingested forecasts are not refreshed")
+            return {}
+        forecasts = pd.to_datetime(manifest["layout"]["forecast"])
+        members = defaultdict(dict)
+        for key, stamps in manifest["regions"].items():
+            mem, nf = key.split("/")
+            members[forecasts[int(nf)]][mem] = stamps
+        return {
+            forecast: hashlib.sha1(
+                json.dumps(stamps, sort_keys=True).encode()
+            ).hexdigest()
+            for forecast, stamps in members.items()
+        }
+
+    def forecast_stats(self, da: xr.DataArray) -> xr.DataArray:
+        """
+        Ensemble statistics of one forecast for every lead window, with
+        dimensions (window, lead, stat, ...); leads are 1-based and windows
+        running past the last lead are NaN. ``da`` is kept lazy: the medians
+        are reduced tile by tile and the rest when the result is written.
+        """
+        nlead = da.sizes[self.lead_dim]
+        if max(self.windows) > nlead:
+            raise ValueError(f"Windows {self.windows} exceed the {nlead} leads")
+        da = da.rename({self.lead_dim: "lead"})
+        da = da.drop_vars([c for c in da.coords if "lead" in da[c].dims])
+        out = []
+        for window in self.windows:
+            # Labelled by their last lead; keep the windows that fit
+            means = da.rolling(lead=window, min_periods=1).mean()
+            means = means.isel(lead=slice(window - 1, None))
+            stats = xr.concat([self._stat(means, s) for s in self.stats], dim="stat")
+            out.append(stats.pad(lead=(0, window - 1)))
+        out = xr.concat(out, dim="window").transpose("window", "lead", "stat", ...)
+        return out.assign_coords(
+            window=list(self.windows),
+            lead=np.arange(1, nlead + 1),
+            stat=list(self.stats),
+        )
+
+    @staticmethod
+    def _stat(da: xr.DataArray, stat: str) -> xr.DataArray:
+        if stat == "mean":
+            return da.mean("member")
+        if stat == "median":
+            return member_median(da)
+        if stat.startswith("mem"):
+            return da.isel(member=int(stat[3:]) - 1, drop=True)
+        raise ValueError(f"Unknown ensemble statistic {stat}")
+
+    def _open(self, group: str) -> xr.DataArray | None:
+        if not Path(self.path, group).exists():
+            return None
+        # Not consolidated: the groups grow between updates
+        return xr.open_zarr(self.path, group=group, consolidated=False)[self.field]
+
+    def _reduce(self, source, forecasts, stamps) -> xr.Dataset:
+        stats = xr.concat(
+            [self.forecast_stats(source.sel(forecast=f)) for f in forecasts],
+            dim=pd.Index(forecasts, name="forecast"),
+        ).astype(np.float32)
+        ds = stats.to_dataset(name=self.field)
+        ds[f"{self.field}_stamp"] = xr.DataArray(
+            np.array([stamps.get(f, "") for f in forecasts], dtype="U40"),
+            dims="forecast",
+        )
+        return ds.chunk({"forecast": 1, "window": 1, "lead": 1, "stat": 1})
+
+    def update(self, batch: int = 12):
+        """
+        Add the forecasts of the store that are missing from the cube,
+        recompute those whose source files changed and refresh the
+        climatologies of their initialisation months.
+        """
+        source = self.source()
+        stamps = self.source_stamps()
+        stored = {}
+        if Path(self.path, "ens").exists():
+            ens = xr.open_zarr(self.path, group="ens", consolidated=False)
+            if f"{self.field}_stamp" in ens:
+                stored = dict(
+                    zip(
+                        pd.to_datetime(ens.forecast.values),
+                        ens[f"{self.field}_stamp"].values,
+                    )
+                )
+            else:
+                logger.info(f"{self.path} has no source stamps, rebuilding it")
+        position = {f: i for i, f in enumerate(stored)}
+        forecasts = pd.to_datetime(source.forecast.values)
+        new = [f for f in forecasts if f not in stored]
+        changed = [
+            f
+            for f in forecasts
+            if f in stored and stamps.get(f, stored[f]) != stored[f]
+        ]
+        logger.info(
+            f"{self.path}: adding {len(new)} forecasts, "
+            f"recomputing {len(changed)} re-ingested ones"
+        )
+        for start in range(0, len(changed), batch):
+            ds = self._reduce(source, changed[start : start + batch], stamps)
+            ds = ds.drop_vars(list(ds.coords))
+            for i, f in enumerate(changed[start : start + batch]):
+                ds.isel(forecast=slice(i, i + 1)).to_zarr(
+                    self.path,
+                    group="ens",
+                    region={"forecast": slice(position[f], position[f] + 1)},
+                )
+        for start in range(0, len(new), batch):
+            ds = self._reduce(source, new[start : start + batch], stamps)
+            if not stored and start == 0:
+                ds.to_zarr(self.path, group="ens", mode="w")
+            else:
+                ds.to_zarr(self.path, group="ens", append_dim="forecast")
+        if new or changed:
+            self._update_clim({f.month for f in new + changed})
+
+    def _update_clim(self, months: set[int]):
+        ens = self._open("ens")
+        clim = self._open("clim")
+        if clim is None:
+            template = ens.isel(forecast=0, drop=True)
+            template = template.expand_dims(init_month=np.arange(1, 13)).chunk(
+                {"init_month": 1, "window": 1, "lead": 1, "stat": 1}
+            )
+            ds = xr.full_like(template, np.nan).to_dataset(name=self.field)
+            ds[f"{self.field}_years"] = xr.DataArray(
+                np.full(12, "", dtype="U512"), dims="init_month"
+            ).chunk(1)
+            ds.to_zarr(self.path, group="clim", mode="w")
+        for month in sorted(months):
+            members = ens.sel(forecast=ens.forecast.dt.month == month)
+            years = " ".join(
+                str(y) for y in sorted(set(members.forecast.dt.year.values))
+            )
+            ds = members.mean("forecast").expand_dims(init_month=[month])
+            ds = ds.drop_vars(list(ds.coords)).to_dataset(name=self.field)
+            ds[f"{self.field}_years"] = xr.DataArray(
+                np.array([years], dtype="U512"), dims="init_month"
+            )
+            ds.to_zarr(
+                self.path,
+                group="clim",
+                region={"init_month": slice(month - 1, month)},
+            )
+
+    def forecasts(self, init_month: int, years=None) -> pd.DatetimeIndex:
+        forecasts = pd.to_datetime(self._open("ens").forecast.values)
+        forecasts = forecasts[forecasts.month == init_month]
+        if years is not None:
+            forecasts = forecasts[forecasts.year.isin(list(years))]
+        return forecasts
+
+    def select(
+        self, init_month: int, lead: int, nmons: int = 1, stat="median", years=None
+    ) -> xr.DataArray:
+        """
+        Mean over the forecasts of ``init_month`` of the ensemble ``stat`` of
+        the ``nmons``-month window starting at ``lead``.
+
+        The precomputed climatology is used when ``years`` covers every
+        ingested year of ``init_month``. The cube is built on first use.
+        Windows or statistics that are not in the cube are reduced from the
+        store.
+        """
+        if nmons not in self.windows or stat not in self.stats:
+            return self._reduce_source(init_month, lead, nmons, stat, years)
+        index = {"window": nmons, "lead": lead, "stat": stat}
+        if not Path(self.path, "clim").exists():
+            self.update()
+        clim = xr.open_zarr(self.path, group="clim", consolidated=False)
+        ingested = str(clim[f"{self.field}_years"].sel(init_month=init_month).values)
+        if years is None or set(map(str, years)) >= set(ingested.split()):
+            return clim[self.field].sel(init_month=init_month, **index, drop=True)
+        ens = self._open("ens").sel(index, drop=True)
+        ens = ens.sel(forecast=self.forecasts(init_month, years))
+        return ens.mean("forecast")
+
+    def _reduce_source(self, init_month, lead, nmons, stat, years) -> xr.DataArray:
+        logger.info(f"{self.path} has no {nmons}-month {stat}, reducing {self.store}")
+        source = self.source()
+        nlead = source.sizes[self.lead_dim]
+        if not 1 <= lead <= lead + nmons - 1 <= nlead:
+            raise ValueError(
+                f"{nmons} months from lead {lead} exceed the {nlead} leads"
+            )
+        forecasts = pd.to_datetime(source.forecast.values)
+        forecasts = forecasts[forecasts.month == init_month]
+        if years is not None:
+            forecasts = forecasts[forecasts.year.isin(list(years))]
+        da = source.sel(forecast=forecasts).isel(
+            {self.lead_dim: slice(lead - 1, lead - 1 + nmons)}
+        )
+        da = self._stat(da.mean(self.lead_dim), stat)
+        return da.mean("forecast").astype(np.float32)
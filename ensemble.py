@@ -0,0 +1,208 @@
+"""
+Ensemble statistics of member files computed together.
+
+The members of a forecast are stacked lazily once and the requested
+statistics (mean, median, std, percentiles like ``p10`` and tercile
+probabilities) are computed from that stack in one dask computation and one
+tiled quantile pass, instead of re-reading the members with one CDO ``ens*``
+call per statistic.
+
+Medians and percentiles are computed by :func:`member_quantiles`, which
+selects them exactly with ``np.partition`` tile by tile in a thread pool,
+holding only a bounded number of tiles of the member stack in memory.
+"""
+
+import itertools
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import dask
+import numpy as np
+import xarray as xr
+
+from cdo_cache import publish
+
+logger = logging.getLogger(__name__)
+
+
+def open_members(paths: list[str], fld: str) -> xr.DataArray:
+    """
+    Lazily stack ``fld`` of the member files along ``member``, aligning
+    timesteps by position like CDO's ens operators.
+    """
+    arrays = [xr.open_dataset(path, chunks={})[fld] for path in paths]
+    return xr.concat(
+        arrays, dim="member", coords="minimal", compat="override", join="override"
+    )
+
+
+def _tile_shape(shape, chunks, itemsize, n, budget) -> tuple[int, ...]:
+    """
+    Largest tile of ``shape`` whose ``n`` members fit in ``budget`` bytes,
+    growing from the last dimension. Along every dimension the tile is a
+    multiple or a divisor of ``chunks``, so that lazy inputs are read once.
+    """
+    tile = [1] * len(shape)
+    # The tile is copied once by the partition
+    points = max(budget // (2 * n * itemsize), 1)
+    for i in reversed(range(len(shape))):
+        if shape[i] <= points:
+            tile[i] = shape[i]
+            points //= shape[i]
+            continue
+        size = max(points, 1)
+        if chunks and size >= chunks[i]:
+            size -= size % chunks[i]
+        elif chunks:
+            size = max(d for d in range(1, size + 1) if chunks[i] % d == 0)
+        tile[i] = size
+        break
+    return tuple(tile)
+
+
+def _quantile_tile(values: np.ndarray, qs: list[float]) -> np.ndarray:
+    n = values.shape[0]
+    positions = [q * (n - 1) for q in qs]
+    kth = sorted({k for p in positions for k in (math.floor(p), math.ceil(p))})
+    if np.issubdtype(values.dtype, np.floating) and np.isnan(values).any():
+        return np.nanquantile(values, qs, axis=0).astype(values.dtype)
+    part = np.partition(values, kth, axis=0)
+    out = np.empty((len(qs),) + values.shape[1:], dtype=values.dtype)
+    for i, p in enumerate(positions):
+        lo, hi = math.floor(p), math.ceil(p)
+        # Linear interpolation between order statistics, as np.quantile
+        out[i] = part[lo] + (part[hi] - part[lo]) * (p - lo)
+    return out
+
+
+def member_quantiles(
+    da: xr.DataArray,
+    qs: list[float],
+    dim: str = "member",
+    memory_limit: int = 2**30,
+    max_workers: int | None = None,
+) -> xr.DataArray:
+    """
+    Exact quantiles of ``da`` over ``dim``, with a leading ``quantile`` dim.
+
+    Parameters:
+    - da: numpy or dask backed; only the tiles being reduced are loaded
+    - qs: quantiles in [0, 1], interpolated linearly like ``np.quantile``
+    - memory_limit: bytes of member stack held by all workers together
+    - max_workers: threads; ``np.partition`` releases the GIL
+    """
+    da = da.transpose(dim, ...)
+    max_workers = max_workers or min(os.cpu_count(), 16)
+    n, shape = da.shape[0], da.shape[1:]
+    chunks = [c[0] for c in da.chunks[1:]] if da.chunks else None
+    tile = _tile_shape(shape, chunks, da.dtype.itemsize, n, memory_limit // max_workers)
+    grid = [range(0, size, step) for size, step in zip(shape, tile)]
+    dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.float64
+    out = np.empty((len(qs),) + shape, dtype=dtype)
+    data = da.data
+
+    def reduce(corner):
+        index = (slice(None),) + tuple(slice(c, c + t) for c, t in zip(corner, tile))
+        values = data[index]
+        if da.chunks:
+            # The pool already provides the parallelism
+            values = values.compute(scheduler="synchronous")
+        out[index] = _quantile_tile(values.astype(dtype, copy=False), qs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(reduce, itertools.product(*grid)))
+    coords = {k: v for k, v in da.coords.items() if dim not in v.dims}
+    return xr.DataArray(
+        out,
+        dims=("quantile",) + da.dims[1:],
+        coords=coords | {"quantile": qs},
+        name=da.name,
+        attrs=da.attrs,
+    )
+
+
+def member_median(da: xr.DataArray, dim: str = "member", **kwargs) -> xr.DataArray:
+    return member_quantiles(da, [0.5], dim, **kwargs).isel(quantile=0, drop=True)
+
+
+def ens_stat(stack: xr.DataArray, stat: str) -> xr.DataArray:
+    if stat == "median":
+        return member_median(stack)
+    if stat in ("mean", "std", "min", "max"):
+        return getattr(stack, stat)("member")
+    if stat.startswith("p"):
+        return member_quantiles(stack, [_quantile(stat)]).isel(quantile=0, drop=True)
+    raise ValueError(f"Unknown ensemble statistic {stat}")
+
+
+def _quantile(stat: str) -> float | None:
+    if stat == "median":
+        return 0.5
+    if stat.startswith("p"):
+        return float(stat[1:]) / 100
+    return None
+
+
+def tercile_probabilities(stack: xr.DataArray, edges: xr.DataArray) -> xr.Dataset:
+    """
+    Fraction of members below, between and above the tercile ``edges``.
+    """
+    lower = edges.isel(quantile=0).values
+    upper = edges.isel(quantile=1).values
+    below = (stack < lower).mean("member")
+    above = (stack > upper).mean("member")
+    return xr.Dataset({"below": below, "normal": 1 - below - above, "above": above})
+
+
+def _write(obj: xr.DataArray | xr.Dataset, output: str):
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    tmp = f"{output}.{os.getpid()}.nc"
+    obj.to_netcdf(tmp)
+    publish(tmp, output)
+
+
+def ens_stats(
+    members: list[str], outputs: dict[str, str], fld: str, edges: str | None = None
+):
+    """
+    Write several ensemble statistics of ``members`` together.
+
+    Parameters:
+    - members: member files of one forecast
+    - outputs: output file keyed by statistic; "terciles" writes the tercile
+      probabilities against ``edges``
+    - fld: variable to reduce
+    - edges: file written by :func:`tercile_edges`
+    """
+    logger.info(f"Ensemble {list(outputs)} of {len(members)} members -> {outputs}")
+    stack = open_members(members, fld)
+    qs = {stat: _quantile(stat) for stat in outputs if _quantile(stat) is not None}
+    lazy = {}
+    for stat in outputs:
+        if stat == "terciles":
+            lazy[stat] = tercile_probabilities(stack, xr.open_dataarray(edges))
+        elif stat not in qs:
+            lazy[stat] = ens_stat(stack, stat)
+    (results,) = dask.compute(lazy)
+    if qs:
+        quantiles = member_quantiles(stack, list(qs.values()))
+        for i, stat in enumerate(qs):
+            results[stat] = quantiles.isel(quantile=i, drop=True)
+    for stat, output in outputs.items():
+        result = results[stat]
+        if stat != "terciles":
+            result = result.astype(stack.dtype).rename(fld)
+        _write(result, output)
+
+
+def tercile_edges(members: list[str], output: str, fld: str):
+    """
+    Climatological tercile edges of all ``members`` (e.g. every member of one
+    initialisation month across the hindcast years) for each timestep.
+    """
+    stack = open_members(members, fld)
+    edges = member_quantiles(stack, [1 / 3, 2 / 3]).astype(np.float32)
+    _write(edges.rename(fld), output)
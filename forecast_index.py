@@ -0,0 +1,129 @@
+"""
+Integer lookup coordinates for selecting forecasts of an ingested store.
+
+:class:`ZarrIngest` stores, next to the ``forecast`` dates, the
+initialisation year and month of every forecast and the valid year and month
+of every (forecast, lead). :class:`ForecastIndex` resolves a selection like
+``select(init_month=12, lead=1, nmons=3, years=range(2009, 2013))`` to integer
+positions for ``isel`` with a few numpy comparisons, instead of building
+masks from ``forecast.dt`` and looping over ``pd.DateOffset``.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+@dataclass
+class ForecastIndex:
+    """
+    Parameters:
+    - lead_dim: lead-month dimension of the store
+    - init_year, init_month: of every forecast
+    - valid_year, valid_month: of every (forecast, lead)
+    """
+
+    lead_dim: str
+    init_year: np.ndarray
+    init_month: np.ndarray
+    valid_year: np.ndarray
+    valid_month: np.ndarray
+
+    @classmethod
+    def build(
+        cls, forecast, lead_dim: str, nlead: int, lead_offset: int = 1
+    ) -> "ForecastIndex":
+        """
+        Parameters:
+        - forecast: forecast (initialisation) dates
+        - nlead: size of ``lead_dim``
+        - lead_offset: months from the forecast date to the first lead, e.g.
+          1 when the spin-up month is dropped
+        """
+        forecast = pd.DatetimeIndex(forecast)
+        months = (
+            forecast.year.values[:, None] * 12
+            + forecast.month.values[:, None]
+            - 1
+            + lead_offset
+            + np.arange(nlead)
+        )
+        return cls(
+            lead_dim,
+            forecast.year.values.astype(np.int16),
+            forecast.month.values.astype(np.int8),
+            (months // 12).astype(np.int16),
+            (months % 12 + 1).astype(np.int8),
+        )
+
+    @classmethod
+    def of(
+        cls, ds: xr.Dataset | xr.DataArray, lead_dim: str = "Times", lead_offset=1
+    ) -> "ForecastIndex":
+        """
+        Index of an ingested store, built from its ``forecast`` dates when the
+        store predates the lookup coordinates.
+        """
+        if "valid_month" not in ds.coords:
+            return cls.build(
+                ds["forecast"].values, lead_dim, ds.sizes[lead_dim], lead_offset
+            )
+        return cls(
+            ds["valid_month"].dims[1],
+            *(
+                ds[c].values
+                for c in ("init_year", "init_month", "valid_year", "valid_month")
+            ),
+        )
+
+    def coords(self) -> dict[str, tuple]:
+        dims = ("forecast", self.lead_dim)
+        return {
+            "init_year": ("forecast", self.init_year),
+            "init_month": ("forecast", self.init_month),
+            "valid_year": (dims, self.valid_year),
+            "valid_month": (dims, self.valid_month),
+        }
+
+    def select(
+        self,
+        init_month: int | None = None,
+        lead: int = 1,
+        nmons: int = 1,
+        years=None,
+        valid_month: int | None = None,
+    ) -> dict[str, np.ndarray]:
+        """
+        Positions along ``forecast`` and ``lead_dim`` of the ``nmons`` leads
+        starting at ``lead`` (1-based) of the forecasts initialised in
+        ``init_month`` of ``years``, or whose ``lead`` is valid in
+        ``valid_month``.
+        """
+        leads = np.arange(lead - 1, lead - 1 + nmons)
+        if leads[-1] >= self.valid_month.shape[1]:
+            raise IndexError(
+                f"Leads {lead}-{lead + nmons - 1} exceed the "
+                f"{self.valid_month.shape[1]} leads of the store"
+            )
+        mask = np.ones(len(self.init_month), dtype=bool)
+        if init_month is not None:
+            mask &= self.init_month == init_month
+        if valid_month is not None:
+            mask &= self.valid_month[:, lead - 1] == valid_month
+        if years is not None:
+            mask &= np.isin(self.init_year, list(years))
+        return {"forecast": np.flatnonzero(mask), self.lead_dim: leads}
+
+    def valid_dates(self, index: dict[str, np.ndarray]) -> pd.DatetimeIndex:
+        """
+        First days of the distinct months covered by a :meth:`select` result.
+        """
+        at = np.ix_(index["forecast"], index[self.lead_dim])
+        months = np.unique(
+            self.valid_year[at].astype(np.int64) * 12 + self.valid_month[at] - 1
+        )
+        return pd.DatetimeIndex(
+            pd.to_datetime({"year": months // 12, "month": months % 12 + 1, "day": 1})
+        )
@@ -0,0 +1,241 @@
+"""
+Byte-offset index of multi-message GRIB files.
+
+The SEAS5 downloads hold every initialisation date, member and lead month of
+a variable in one file. :func:`build_index` reads the message headers once
+and records where each message starts, so that the messages of one (date,
+member) group can be read or split out without scanning the file again.
+
+:class:`GribIndexBackend` is an xarray engine that decodes such a group
+straight from its byte offsets, so that the ingest can read the download
+directly, e.g. ``FieldSpec(..., sources={"grib": indexed_source(path)},
+engine=GribIndexBackend)``.
+"""
+
+import json
+import logging
+import os
+import typing as t
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass
+from functools import lru_cache
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import eccodes
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends import BackendEntrypoint
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Message:
+    offset: int
+    length: int
+    date: int  # dataDate, YYYYMMDD
+    number: int
+    step: int  # forecastMonth for monthly products, hours otherwise
+    name: str
+
+
+@dataclass
+class GribIndex:
+    path: str
+    messages: list[Message]
+
+    def groups(
+        self, by: t.Sequence[str] = ("date", "number")
+    ) -> dict[tuple, list[Message]]:
+        """
+        Messages grouped by the values of the ``by`` fields, in file order.
+        """
+        groups = defaultdict(list)
+        for msg in self.messages:
+            groups[tuple(getattr(msg, k) for k in by)].append(msg)
+        return dict(groups)
+
+    def read(self, messages: list[Message]) -> bytes:
+        """
+        Raw bytes of ``messages``; adjacent messages are read in one call.
+        """
+        messages = sorted(messages, key=lambda m: m.offset)
+        parts = []
+        with open(self.path, "rb") as f:
+            start, end = messages[0].offset, messages[0].offset
+            for msg in messages:
+                if msg.offset != end:
+                    parts.append(os.pread(f.fileno(), end - start, start))
+                    start = msg.offset
+                end = msg.offset + msg.length
+            parts.append(os.pread(f.fileno(), end - start, start))
+        return b"".join(parts)
+
+
+def _header(h) -> Message:
+    if eccodes.codes_is_defined(h, "forecastMonth"):
+        step = eccodes.codes_get(h, "forecastMonth", int)
+    else:
+        step = eccodes.codes_get(h, "step", int)
+    return Message(
+        offset=int(eccodes.codes_get(h, "offset")),
+        length=eccodes.codes_get(h, "totalLength", int),
+        date=eccodes.codes_get(h, "dataDate", int),
+        number=eccodes.codes_get(h, "number", int),
+        step=step,
+        name=eccodes.codes_get(h, "shortName"),
+    )
+
+
+def scan(path: str) -> list[Message]:
+    messages = []
+    with open(path, "rb") as f:
+        while (h := eccodes.codes_grib_new_from_file(f, headers_only=True)) is not None:
+            try:
+                messages.append(_header(h))
+            finally:
+                eccodes.codes_release(h)
+    return messages
+
+
+def build_index(path: str) -> GribIndex:
+    """
+    Index the messages of ``path``, reusing ``<path>.idx.json`` if it was
+    built from the current version of the file.
+    """
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    index_path = Path(f"{path}.idx.json")
+    if index_path.exists():
+        saved = json.loads(index_path.read_text())
+        if saved["stamp"] == stamp:
+            return GribIndex(path, [Message(*m) for m in saved["messages"]])
+    logger.info(f"Indexing {path}")
+    messages = scan(path)
+    tmp = index_path.with_suffix(".tmp")
+    tmp.write_text(
+        json.dumps({"stamp": stamp, "messages": [astuple(m) for m in messages]})
+    )
+    os.replace(tmp, index_path)
+    return GribIndex(path, messages)
+
+
+def split(path: str, output: str, max_workers: int = 16) -> list[str]:
+    """
+    Write the messages of every (initialisation date, member) of ``path`` to
+    their own file.
+
+    Parameters:
+    - path: GRIB file to split
+    - output: path template formatted with ``date`` (a Timestamp) and
+      ``number``
+    - max_workers: number of files written concurrently
+    """
+    index = build_index(path)
+
+    def write(key, messages):
+        date, number = key
+        out = Path(output.format(date=pd.Timestamp(str(date)), number=number))
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_suffix(".tmp")
+        tmp.write_bytes(index.read(messages))
+        os.replace(tmp, out)
+        return str(out)
+
+    groups = index.groups()
+    logger.info(f"Splitting {path} into {len(groups)} files")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda kv: write(*kv), groups.items()))
+
+
+def indexed_source(path: str) -> str:
+    """
+    Source template selecting the messages of one forecast and member of
+    ``path``, for :class:`ingest.FieldSpec` with ``engine=GribIndexBackend``.
+
+    The index is built here so that the workers do not all build it.
+    """
+    build_index(path)
+    # The "::" prefix keeps xarray from treating the selector as a local file
+    return f"gribindex::{path}#date={{fdate}}&number={{mem}}"
+
+
+@lru_cache(maxsize=8)
+def _cached_index(path: str, stamp: tuple[int, int]) -> GribIndex:
+    return build_index(path)
+
+
+def _decode(message: bytes) -> tuple[dict, np.ndarray]:
+    h = eccodes.codes_new_from_message(message)
+    try:
+        if eccodes.codes_get(h, "gridType") != "regular_ll":
+            raise ValueError("Only regular_ll GRIB grids are supported")
+        shape = (eccodes.codes_get(h, "Nj"), eccodes.codes_get(h, "Ni"))
+        values = eccodes.codes_get_values(h).reshape(shape).astype("float32")
+        if eccodes.codes_get(h, "bitmapPresent"):
+            values[values == eccodes.codes_get(h, "missingValue")] = np.nan
+        meta = {
+            "name": eccodes.codes_get(h, "cfVarName"),
+            "attrs": {
+                "units": eccodes.codes_get(h, "units"),
+                "long_name": eccodes.codes_get(h, "name"),
+            },
+            "latitude": eccodes.codes_get_array(h, "latitudes").reshape(shape)[:, 0],
+            "longitude": eccodes.codes_get_array(h, "longitudes").reshape(shape)[0],
+        }
+    finally:
+        eccodes.codes_release(h)
+    return meta, values
+
+
+def open_group(selector: str) -> xr.Dataset:
+    """
+    Decode the messages selected by ``"gribindex::<path>#date=YYYYMM&number=N"``.
+
+    Variables have dimensions (step, latitude, longitude), with the lead
+    months along ``step`` as in the cfgrib datasets of the split files.
+    """
+    path, _, query = selector.removeprefix("gribindex::").partition("#")
+    select = dict(parse_qsl(query))
+    stat = os.stat(path)
+    index = _cached_index(path, (stat.st_mtime_ns, stat.st_size))
+    date, number = int(select["date"]), int(select["number"])
+    messages = [
+        m for m in index.messages if m.date // 100 == date and m.number == number
+    ]
+    if not messages:
+        raise KeyError(f"No messages for {selector}")
+    data, meta = defaultdict(list), {}
+    for msg in sorted(messages, key=lambda m: (m.name, m.step)):
+        meta[msg.name], values = _decode(index.read([msg]))
+        data[msg.name].append(values)
+    first = next(iter(meta.values()))
+    return xr.Dataset(
+        {
+            m["name"]: (
+                ("step", "latitude", "longitude"),
+                np.stack(data[k]),
+                m["attrs"],
+            )
+            for k, m in meta.items()
+        },
+        coords={
+            "latitude": ("latitude", first["latitude"], {"units": "degrees_north"}),
+            "longitude": ("longitude", first["longitude"], {"units": "degrees_east"}),
+        },
+    )
+
+
+class GribIndexBackend(BackendEntrypoint):
+    description = "Open one (date, member) group of an indexed GRIB file"
+    open_dataset_parameters = ("filename_or_obj", "drop_variables")
+
+    def open_dataset(self, filename_or_obj, *, drop_variables=None):
+        ds = open_group(str(filename_or_obj))
+        return ds.drop_vars(drop_variables or [], errors="ignore")
+
+    def guess_can_open(self, filename_or_obj):
+        return False
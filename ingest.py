@@ -0,0 +1,638 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import typing as t
+import warnings
+import zipfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import dask
+import pandas as pd
+import xarray as xr
+import zarr
+from dask.distributed import Client, LocalCluster, as_completed
+
+import cdo_native
+from cdo_cache import CdoCache
+from forecast_index import ForecastIndex
+from storage import StoragePolicy
+
+logger = logging.getLogger(__name__)
+
+APSEAS_ROOT = "/scratch/athippp/cylc-archive"
+
+Sources = dict[str, xr.Dataset]
+
+
+def apseas_source(exp: str, file_name: str) -> str:
+    return f"{APSEAS_ROOT}/{exp}/{{fdate}}02T0000Z/mem{{mem}}/outputs/{file_name}"
+
+
+def cdo_rate(infile: str) -> str:
+    """CDO chain turning an accumulated field into per-timestep increments."""
+    return f"-sub -seltimestep,2/-1 {infile} -seltimestep,1/-2 {infile}"
+
+
+@dataclass
+class FieldSpec:
+    """
+    Declarative description of one field written to a zarr store.
+
+    Parameters:
+    - name: name of the data variable in the store
+    - sources: source path templates keyed by name; formatted with ``fdate``
+      (YYYYMM of the forecast date) and ``mem`` (member number)
+    - cdo_opr: optional CDO chain formatted with ``name`` and the source keys,
+      e.g. ``"-setname,{name} -monmean {T2}"``; when it is not set the single
+      source is used as is
+    - backend: ``"native"`` evaluates ``cdo_opr`` in-process with
+      :mod:`cdo_native` on the already opened sources, falling back to CDO
+      for unsupported operators; ``"cdo"`` always runs CDO
+    - preprocess: optional function applied to the derived dataset
+    - rename: variables to rename after preprocessing
+    - drop_vars: variables to drop after renaming
+    - engine: xarray engine used to open the sources
+    - member_offset: added to the 0-based member index when formatting ``mem``
+    """
+
+    name: str
+    sources: dict[str, str]
+    cdo_opr: str | None = None
+    backend: str = "native"
+    preprocess: t.Callable[[xr.Dataset], xr.Dataset] | None = None
+    rename: dict[str, str] = field(default_factory=dict)
+    drop_vars: set[str] = field(default_factory=set)
+    engine: str | None = None
+    member_offset: int = 1
+
+    def source_paths(self, date: pd.Timestamp, mem: int) -> dict[str, str]:
+        fmt = {"fdate": date.strftime("%Y%m"), "mem": mem + self.member_offset}
+        return {k: v.format(**fmt) for k, v in self.sources.items()}
+
+    def open_sources(self, paths: dict[str, str], chunks=None) -> Sources:
+        chunks = {} if chunks is None else chunks
+        return {
+            k: xr.open_dataset(v, chunks=chunks, engine=self.engine)
+            for k, v in paths.items()
+        }
+
+    def derive(self, paths: dict[str, str], sources: Sources) -> xr.Dataset:
+        if self.cdo_opr is not None:
+            ds = self._cdo(self.cdo_opr.format(name=self.name, **paths), paths, sources)
+        elif len(sources) == 1:
+            (ds,) = sources.values()
+        else:
+            raise ValueError(
+                f"{self.name}: cdo_opr is required to combine sources {list(paths)}"
+            )
+        if self.preprocess is not None:
+            ds = self.preprocess(ds)
+        ds = ds.rename_vars(self.rename)
+        return ds.drop_vars(self.drop_vars, errors="ignore")
+
+    def _cdo(self, chain: str, paths: dict[str, str], sources: Sources):
+        if self.backend == "native":
+            opened = {paths[k]: ds for k, ds in sources.items()}
+
+            def open_file(path):
+                if path in opened:
+                    return opened[path]
+                return xr.open_dataset(path, chunks={}, engine=self.engine)
+
+            try:
+                return cdo_native.evaluate(chain, open_file)
+            except cdo_native.UnsupportedOperator as e:
+                logger.warning(f"{self.name}: no native -{e}, running CDO instead")
+        return xr.open_dataset(_cdo_execute(chain), chunks={})
+
+
+@dataclass
+class Manifest:
+    """
+    Sidecar record of the regions already written to a store.
+
+    Each region key maps to the ``(mtime_ns, size)`` of its source files when
+    it was written, so that regions whose sources changed are rewritten.
+    ``layout`` describes the store; a manifest with another layout is
+    discarded.
+    """
+
+    path: str
+    layout: dict
+    regions: dict[str, dict[str, list[int]]] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: str, layout: dict) -> t.Optional["Manifest"]:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if data.get("layout") != layout:
+            logger.info(f"{path} was written for another layout, ignoring it")
+            return None
+        return cls(path, layout, data["regions"])
+
+    def is_done(self, key: str, stamps: dict[str, list[int]]) -> bool:
+        return self.regions.get(key) == stamps
+
+    def record(self, key: str, stamps: dict[str, list[int]]):
+        self.regions[key] = stamps
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"layout": self.layout, "regions": self.regions}, f)
+        os.replace(tmp, self.path)
+
+
+class ZipWriter:
+    """
+    Single writer appending a zarr store to a zip file.
+
+    The zip is written as ``<path>.partial`` and only renamed to ``path`` by
+    :meth:`finish`. Every :meth:`checkpoint` closes the zip, which writes its
+    central directory, and keeps a copy of that directory in
+    ``<path>.partial.cd``. A later writer resuming the file truncates it back
+    to the last checkpoint, so a crash only loses the chunks appended since.
+    With ``reopen`` the finished ``path`` is moved back to ``<path>.partial``
+    and appended to, so that only the rewritten chunks are added to it;
+    :meth:`finish` then drops the copies they replace.
+    """
+
+    def __init__(self, path: str, resume: bool = False, reopen: bool = False):
+        self.path = path
+        self.partial = f"{path}.partial"
+        self.cd = f"{self.partial}.cd"
+        if reopen:
+            os.replace(self.path, self.partial)
+            self._save_directory()
+            self.store = zarr.storage.ZipStore(self.partial, mode="a")
+        elif resume:
+            self._restore()
+            self.store = zarr.storage.ZipStore(self.partial, mode="a")
+        else:
+            self.store = zarr.storage.ZipStore(self.partial, mode="w")
+
+    def _restore(self):
+        with open(self.cd, "rb") as f:
+            offset = int.from_bytes(f.read(8), "little")
+            directory = f.read()
+        with open(self.partial, "r+b") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(directory)
+
+    def checkpoint(self):
+        self.store.close()
+        self._save_directory()
+        self.store = zarr.storage.ZipStore(self.partial, mode="a")
+
+    def _save_directory(self):
+        with zipfile.ZipFile(self.partial) as zf:
+            offset = zf.start_dir
+        with open(self.partial, "rb") as f:
+            f.seek(offset)
+            directory = f.read()
+        tmp = f"{self.cd}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(offset.to_bytes(8, "little"))
+            f.write(directory)
+        os.replace(tmp, self.cd)
+
+    def finish(self):
+        self.store.close()
+        if self._compact():
+            # The partial zip stays resumable until the compacted one is in place
+            os.remove(self.partial)
+        else:
+            os.replace(self.partial, self.path)
+        os.remove(self.cd)
+
+    def _compact(self) -> bool:
+        """
+        Write ``path`` with only the last copy of the chunks rewritten since
+        :meth:`__init__` reopened the zip; False if there are none.
+        """
+        tmp = f"{self.path}.tmp"
+        with zipfile.ZipFile(self.partial) as zf:
+            entries = zf.infolist()
+            # Later entries of a name shadow the earlier ones
+            latest = {entry.filename: entry for entry in entries}
+            if len(latest) == len(entries):
+                return False
+            logger.info(
+                f"Compacting {self.path}: dropping "
+                f"{len(entries) - len(latest)} rewritten chunks"
+            )
+            with zipfile.ZipFile(tmp, "w", allowZip64=True) as out:
+                for entry in latest.values():
+                    with (
+                        zf.open(entry) as src,
+                        out.open(entry, "w", force_zip64=True) as dst,
+                    ):
+                        shutil.copyfileobj(src, dst)
+        os.replace(tmp, self.path)
+        return True
+
+
+class _BlockWriter:
+    """
+    Collects the derived regions of one store and writes them by chunk block.
+
+    Regions are buffered until every pending region of their (member,
+    forecast) chunk block has arrived, so that each chunk is written once
+    instead of being read, modified and rewritten per region. The regions
+    are submitted in block order, so only the blocks in flight are buffered.
+    ``target`` is a store path or a :class:`ZipWriter`, whose store is
+    replaced at every checkpoint.
+    """
+
+    def __init__(self, target, block: dict[str, int], manifest, stamps):
+        self.target = target
+        self.block = block
+        self.manifest = manifest
+        self.stamps = stamps
+        self.expected = defaultdict(set)
+        self.buffers = defaultdict(dict)
+
+    def _store(self):
+        if isinstance(self.target, ZipWriter):
+            return self.target.store
+        return self.target
+
+    def _key(self, region):
+        return tuple(region[d].start // self.block[d] for d in ("member", "forecast"))
+
+    def expect(self, key, region):
+        self.expected[self._key(region)].add(key)
+
+    def add(self, key, region, ds):
+        blk = self._key(region)
+        self.buffers[blk][key] = region, ds
+        self._flush_if_complete(blk)
+
+    def drop(self, key, region):
+        blk = self._key(region)
+        self.expected[blk].discard(key)
+        self._flush_if_complete(blk)
+
+    def _flush_if_complete(self, blk):
+        buffer = self.buffers[blk]
+        if not buffer or len(buffer) < len(self.expected[blk]):
+            return
+        regions = [region for region, _ in buffer.values()]
+        members = sorted({r["member"].start for r in regions})
+        forecasts = sorted({r["forecast"].start for r in regions})
+        if len(members) * len(forecasts) == len(buffer) and all(
+            b - a == 1 for x in (members, forecasts) for a, b in zip(x, x[1:])
+        ):
+            by_index = {
+                (r["forecast"].start, r["member"].start): ds
+                for r, ds in buffer.values()
+            }
+            grid = [[by_index[(f, m)] for m in members] for f in forecasts]
+            ds = xr.combine_nested(grid, concat_dim=["forecast", "member"])
+            region = {
+                "member": slice(members[0], members[-1] + 1),
+                "forecast": slice(forecasts[0], forecasts[-1] + 1),
+            }
+            writes = [(region, ds)]
+        else:
+            writes = list(buffer.values())
+        with warnings.catch_warnings():
+            # Rewritten chunks are appended to a reopened zip, see ZipWriter
+            warnings.filterwarnings("ignore", "Duplicate name", UserWarning)
+            for region, ds in writes:
+                ds.to_zarr(self._store(), region=region)
+        for key in buffer:
+            self.manifest.record(key, self.stamps[key])
+        del self.buffers[blk], self.expected[blk]
+
+
+@dataclass
+class ZarrIngest:
+    """
+    Write fields for every (member, forecast) pair into zarr stores.
+
+    All ``specs`` must read the same sources: each (member, forecast) task
+    opens them once and derives every field from them in a single dask
+    computation, so shared inputs are only read once. ``store`` is formatted
+    with the field ``name``.
+
+    The stores are laid out from the first member of the first forecast,
+    chunked and compressed according to ``storage``, and the (member,
+    forecast) regions are derived by dask workers. With ``zip`` the workers
+    return the regions and the client writes them straight into
+    ``<store>.zip`` through a :class:`ZipWriter`. Otherwise they are written
+    into a directory store, by the workers themselves when every chunk holds
+    a single region.
+
+    With ``lead_dim`` the stores get the lookup coordinates of
+    :class:`ForecastIndex`, whose first lead is ``lead_offset`` months after
+    the forecast date.
+
+    Written regions are recorded in ``<store>.manifest.json``. With
+    ``restart`` a rerun keeps the existing store and only writes the regions
+    that are missing or whose source files changed since.
+    """
+
+    specs: list[FieldSpec]
+    store: str
+    forecast_dates: pd.DatetimeIndex
+    members: int = 25
+    n_workers: int = 100
+    storage: StoragePolicy = field(default_factory=StoragePolicy)
+    source_chunks: dict[str, int] = field(default_factory=dict)
+    zip: bool = True
+    restart: bool = True
+    save_every: int = 50
+    lead_dim: str | None = None
+    lead_offset: int = 1
+
+    def __post_init__(self):
+        first = self.specs[0]
+        for spec in self.specs[1:]:
+            if (spec.sources, spec.engine, spec.member_offset) != (
+                first.sources,
+                first.engine,
+                first.member_offset,
+            ):
+                raise ValueError(
+                    f"{spec.name} does not share the sources of {first.name}"
+                )
+
+    def stores(self) -> dict[str, str]:
+        return {spec.name: self.store.format(name=spec.name) for spec in self.specs}
+
+    def regions(self):
+        for nf, date in enumerate(self.forecast_dates):
+            for mem in range(self.members):
+                region = {
+                    "member": slice(mem, mem + 1),
+                    "forecast": slice(nf, nf + 1),
+                }
+                yield f"{mem}/{nf}", self.specs[0].source_paths(date, mem), region
+
+    def template(self, spec: FieldSpec) -> xr.Dataset:
+        paths = spec.source_paths(self.forecast_dates[0], 0)
+        ds = spec.derive(paths, spec.open_sources(paths, self.source_chunks))
+        ds = self.storage.apply(ds)
+        ds = ds.expand_dims({"member": self.members}).expand_dims(
+            {"forecast": self.forecast_dates}
+        )
+        if self.lead_dim:
+            index = ForecastIndex.build(
+                self.forecast_dates,
+                self.lead_dim,
+                ds.sizes[self.lead_dim],
+                self.lead_offset,
+            )
+            ds = ds.assign_coords(index.coords())
+        ds = ds.chunk(self.storage.resolve(ds))
+        for c in ds.coords:
+            ds[c].load()
+        return ds
+
+    def prepare(self, spec: FieldSpec, store: str, stamps: dict):
+        """
+        Lay out ``store`` unless it can be resumed.
+
+        Returns the manifest of the store, the :class:`ZipWriter` for it (or
+        ``None`` when writing to a directory or the zip is up to date) and
+        its chunk size along member and forecast.
+        """
+        ds = self.template(spec)
+        layout = _layout(ds) | {
+            "zip": self.zip,
+            "storage": self.storage.describe(),
+            "recipe": _recipe(spec),
+        }
+        block = {d: ds.chunks[d][0] for d in ("member", "forecast")}
+        manifest_path = f"{store}.manifest.json"
+        manifest = Manifest.load(manifest_path, layout) if self.restart else None
+        if manifest is not None:
+            done = all(manifest.is_done(k, v) for k, v in stamps.items())
+            if self.zip and Path(f"{store}.zip.partial.cd").exists():
+                logger.info(
+                    f"Resuming {store}.zip: {len(manifest.regions)} regions done"
+                )
+                return manifest, ZipWriter(f"{store}.zip", resume=True), block
+            if self.zip and Path(f"{store}.zip").exists():
+                if done:
+                    logger.info(f"{store}.zip is up to date")
+                    return manifest, None, block
+                logger.info(
+                    f"Updating {store}.zip: {len(manifest.regions)} regions done"
+                )
+                return manifest, ZipWriter(f"{store}.zip", reopen=True), block
+            if not self.zip and Path(store).exists():
+                logger.info(f"Resuming {store}: {len(manifest.regions)} regions done")
+                return manifest, None, block
+        Path(store).parent.mkdir(parents=True, exist_ok=True)
+        # Reset the manifest first so that it never describes the new store
+        manifest = Manifest(manifest_path, layout)
+        manifest.save()
+        logger.info(ds)
+        if self.storage.precision:
+            logger.info(
+                f"Storing {store} as {self.storage.precision.dtype}, error bound "
+                f"{self.storage.precision.error_bound()}"
+            )
+        writer = ZipWriter(f"{store}.zip") if self.zip else None
+        ds.to_zarr(
+            writer.store if writer else store,
+            compute=False,
+            mode="w",
+            encoding=self.storage.encoding(ds),
+        )
+        ds.close()
+        if writer:
+            writer.checkpoint()
+        return manifest, writer, block
+
+    def run(self):
+        stores = self.stores()
+        regions = list(self.regions())
+        stamps = {key: _stamp(paths) for key, paths, _ in regions}
+        manifests, writers, blocks = {}, {}, {}
+        for spec in self.specs:
+            manifests[spec.name], writers[spec.name], blocks[spec.name] = self.prepare(
+                spec, stores[spec.name], stamps
+            )
+        # Workers can only write concurrently when no two regions share a chunk
+        direct = not self.zip and all(
+            block == {"member": 1, "forecast": 1} for block in blocks.values()
+        )
+        block_writers = {
+            spec.name: _BlockWriter(
+                writers[spec.name] or stores[spec.name],
+                blocks[spec.name],
+                manifests[spec.name],
+                stamps,
+            )
+            for spec in self.specs
+        }
+
+        def checkpoint():
+            # Chunks must be durable before the manifest claims them
+            for writer in writers.values():
+                if writer:
+                    writer.checkpoint()
+            for manifest in manifests.values():
+                manifest.save()
+
+        pending = []
+        for key, paths, region in regions:
+            specs = [
+                spec
+                for spec in self.specs
+                if not manifests[spec.name].is_done(key, stamps[key])
+            ]
+            if specs:
+                pending.append((key, paths, region, specs))
+                for spec in specs:
+                    block_writers[spec.name].expect(key, region)
+        # Submitted block by block, so that each block is flushed as soon as
+        # its regions arrive instead of all blocks waiting for the last member
+        block = blocks[self.specs[0].name]
+        pending.sort(
+            key=lambda p: tuple(
+                p[2][d].start // block[d] for d in ("forecast", "member")
+            )
+        )
+        logger.info(f"Writing {len(pending)} of {len(regions)} regions")
+        failed = 0
+        if pending:
+            with (
+                LocalCluster(n_workers=self.n_workers, threads_per_worker=1) as cluster,
+                Client(cluster) as client,
+            ):
+                futures = {}
+                for key, paths, region, specs in pending:
+                    if direct:
+                        future = client.submit(
+                            _write_to_zarr,
+                            specs,
+                            paths,
+                            {spec.name: stores[spec.name] for spec in specs},
+                            region,
+                            self.source_chunks,
+                            self.storage,
+                        )
+                    else:
+                        future = client.submit(
+                            _derive_region,
+                            specs,
+                            paths,
+                            self.source_chunks,
+                            self.storage,
+                        )
+                    futures[future] = key, specs, region
+                for n, future in enumerate(as_completed(futures), 1):
+                    key, specs, region = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception:
+                        logger.exception(f"Failed to write region {key}")
+                        failed += 1
+                        for spec in specs:
+                            block_writers[spec.name].drop(key, region)
+                        continue
+                    finally:
+                        future.release()
+                    for spec, ds in zip(specs, result):
+                        if direct:
+                            manifests[spec.name].record(key, stamps[key])
+                        else:
+                            block_writers[spec.name].add(key, region, ds)
+                    if n % self.save_every == 0:
+                        checkpoint()
+        checkpoint()
+        if failed:
+            raise RuntimeError(f"{failed} regions failed, rerun to write them")
+        for writer in writers.values():
+            if writer:
+                writer.finish()
+
+
+def _stamp(paths: dict[str, str]) -> dict[str, list[int]]:
+    stamps = {}
+    for path in paths.values():
+        # Indexed GRIB sources are "gribindex::<file>#<selection>"
+        st = os.stat(path.rpartition("::")[2].partition("#")[0])
+        stamps[path] = [st.st_mtime_ns, st.st_size]
+    return stamps
+
+
+def _layout(ds: xr.Dataset) -> dict:
+    return {
+        "forecast": [str(d) for d in ds["forecast"].values],
+        "variables": {
+            str(k): [list(v.shape), str(v.dtype)] for k, v in ds.data_vars.items()
+        },
+        "chunks": {str(k): v[0] for k, v in ds.chunks.items()},
+    }
+
+
+def _recipe(spec: FieldSpec) -> dict:
+    """How ``spec`` derives its field, so that changing it relays the store."""
+    preprocess = None
+    if spec.preprocess is not None:
+        func = spec.preprocess
+        preprocess = f"{func.__module__}.{func.__qualname__}"
+        try:
+            source = inspect.getsource(func)
+        except (OSError, TypeError):
+            pass
+        else:
+            preprocess += f":{hashlib.sha1(source.encode()).hexdigest()[:16]}"
+    return {
+        "sources": spec.sources,
+        "cdo_opr": spec.cdo_opr,
+        "backend": spec.backend,
+        "preprocess": preprocess,
+        "rename": spec.rename,
+        "drop_vars": sorted(spec.drop_vars),
+        "engine": spec.engine,
+        "member_offset": spec.member_offset,
+    }
+
+
+def _derive_region(
+    specs: list[FieldSpec], paths, source_chunks, storage: StoragePolicy
+) -> list[xr.Dataset]:
+    sources = specs[0].open_sources(paths, source_chunks)
+    derived = [storage.apply(spec.derive(paths, sources)) for spec in specs]
+    # One computation for all fields so that shared source chunks are read once
+    (derived,) = dask.compute(derived, scheduler="synchronous")
+    for ds in sources.values():
+        ds.close()
+    regions = []
+    for ds in derived:
+        # Coordinates are already in the store and cannot be written by region
+        ds = ds.drop_vars(list(ds.coords))
+        regions.append(ds.expand_dims({"member": 1}).expand_dims({"forecast": 1}))
+    return regions
+
+
+def _write_to_zarr(
+    specs: list[FieldSpec], paths, stores, region, source_chunks, storage
+):
+    logger.info(f"Writing {region} to {list(stores.values())}")
+    derived = _derive_region(specs, paths, source_chunks, storage)
+    for spec, ds in zip(specs, derived):
+        ds.to_zarr(stores[spec.name], region=region)
+    return [None] * len(derived)
+
+
+_CDO_CACHE = CdoCache()
+
+
+def _cdo_execute(input):
+    return _CDO_CACHE.get(input)
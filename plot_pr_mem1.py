@@ -1,13 +1,12 @@
 from pathlib import Path
 
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
 import colorcet as cc
 import matplotlib.pyplot as plt
 import numpy as np
 import xarray as xr
 
-from utils import calculate_colormap_range, get_cmap, get_lon_lat
+from render import draw_map, lambert_conformal
+from utils import calculate_colormap_range, get_cmap
 
 fname = Path(__file__).stem
 
@@ -42,11 +41,7 @@ for k in datasets:
     ]
     ds[k].values *= datasets[k][4]
 
-proj = ccrs.LambertConformal(
-    central_longitude=45,
-    central_latitude=27,
-    standard_parallels=(18, 27),
-)
+proj = lambert_conformal()
 
 keys = ("SeasAP", "Seas5", "ERA5")
 fig, axes = plt.subplots(
@@ -71,19 +66,7 @@ for m in range(3):
         # Model data for the given month
         ax = axes[m, i]
         darray = darrays[i]
-        lon, lat = get_lon_lat(darray)
-        values = darray.values
-        cs = ax.pcolormesh(
-            lon,
-            lat,
-            values,
-            transform=ccrs.PlateCarree(),
-            cmap=cmap,
-            norm=norm,
-        )
-
-        ax.coastlines()
-        ax.add_feature(cfeature.BORDERS)
+        cs = draw_map(ax, darray, cmap, norm)
         ax.set_title(f"{k} - lead month {mm+1}")
 
     # Add a single colorbar for all subplots
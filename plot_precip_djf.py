@@ -7,17 +7,25 @@ import colorcet as cc
 import matplotlib.pyplot as plt
 import pandas as pd
 import xarray as xr
-import xesmf as xe
-from joblib import Memory
 from matplotlib import gridspec
 
+from analysis_cache import AnalysisCache
+from climatology import Climatology
+from ensemble import member_median
+from forecast_index import ForecastIndex
+from regrid import regrid
 from utils import get_cmap, get_lon_lat
 
 fname = Path(__file__).stem
-memory = Memory("cache")
+memory = AnalysisCache()
 
 
-@memory.cache
+@memory.cache(
+    inputs=[
+        "/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINNC.nc",
+        "/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINC.nc",
+    ],
+)
 def ymonmean_precip_wrfapseas(
     exp_name: str,
     month: int,
@@ -55,7 +63,6 @@ def ymonmean_precip_wrfapseas(
     return ds
 
 
-@memory.cache
 def ymonmean_precip_apseas(
     month: int,
     lead: int,
@@ -69,25 +76,17 @@ def ymonmean_precip_apseas(
     assert nmons > 0 and nmons < 6
     assert lead + nmons - 1 < 6
 
-    ds = xr.open_zarr(f"data/ap84SeasRF/{field}.zarr.zip")[field]
     forecast_month = month - lead
     if forecast_month < 1:
         forecast_month += 12
 
-    Times = slice(lead - 1, lead + nmons - 1)
-    ds = ds.sel(forecast=[year in list(yearrange) for year in ds.forecast.dt.year])
-    ds = ds.sel(forecast=ds.forecast.dt.month == forecast_month).isel(Times=Times)
-    ds = ds.isel(south_north=slice(5, -5), west_east=slice(5, -5))
-    # get DateTimeIndex by adding Times months to forecast.values
-    dates = pd.to_datetime([])
-    print(ds["forecast"].values)
-    for i in range(nmons):
-        dates = dates.union(
-            pd.to_datetime(ds["forecast"].values) + pd.DateOffset(months=lead + i)
-        )
-    ds = ds.mean("Times")
-
-    ds = ens_stat(ensstat, ds)
+    # Ensemble statistics are precomputed per lead window by Climatology.update
+    clim = Climatology(f"data/ap84SeasRF/{field}.zarr.zip", field)
+    stat = ensstat if ensstat in ("mean", "median") else "mem1"
+    ds = clim.select(forecast_month, lead, nmons, stat, yearrange)
+    ds = ds.isel(south_north=slice(5, -5), west_east=slice(5, -5)).load()
+    index = ForecastIndex.of(clim.source())
+    dates = index.valid_dates(index.select(forecast_month, lead, nmons, yearrange))
     return ds, dates
 
 
@@ -95,13 +94,16 @@ def ens_stat(ensstat, ds):
     if ensstat == "mean":
         ds = ds.mean("member").mean("forecast")
     elif ensstat == "median":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     else:
         ds = ds.isel(member=0).mean("forecast")
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(
+    inputs=["/project/k10035/athippp/DATA/SEAS5/monthly/precip.zarr.zip"],
+    grids=["to_grid"],
+)
 def ymonmean_precip_seas5(
     month: int,
     lead: int,
@@ -119,23 +121,17 @@ def ymonmean_precip_seas5(
     if forecast_month < 1:
         forecast_month += 12
 
-    Times = slice(lead - 1, lead + nmons - 1)
-    ds = ds.sel(forecast=[year in list(yearrange) for year in ds.forecast.dt.year])
-    ds = (
-        ds.sel(forecast=ds.forecast.dt.month == forecast_month)
-        .isel(step=Times)
-        .mean("step")
-    )
+    # SEAS5 monthly means start with the initialisation month
+    index = ForecastIndex.of(ds, "step", lead_offset=0)
+    ds = ds.isel(index.select(forecast_month, lead, nmons, yearrange)).mean("step")
     ds = ens_stat(ensstat, ds)
     ds = ds * 86400 * 30 * 1000  # convert to mm/month
     ds.load()
-    if "SEAS5" not in REGRIDDERS:
-        REGRIDDERS["SEAS5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["SEAS5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(inputs=["obs_data/era5_surface_fields.nc"], grids=["to_grid"])
 def ymonmean_precip_era5(dates, to_grid):
     yearmons = [(dt.year, dt.month) for dt in dates]
     print(yearmons)
@@ -151,13 +147,14 @@ def ymonmean_precip_era5(dates, to_grid):
     ds = ds.mean("time")
     ds = ds * 86400 * 30  # convert to mm/month
     ds.load()
-    if "ERA5" not in REGRIDDERS:
-        REGRIDDERS["ERA5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["ERA5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(
+    inputs=["/project/k10035/athippp/DATA/TRMM/monthly/trmm_2000-2019_monthly.nc"],
+    grids=["to_grid"],
+)
 def ymonmean_precip_trmm(dates, to_grid):
     yearmons = [(dt.year, dt.month) for dt in dates]
     print(yearmons)
@@ -173,15 +170,10 @@ def ymonmean_precip_trmm(dates, to_grid):
     ds = ds.mean("time")
     ds = ds * 30  # convert to mm/month
     ds.load()
-    if "TRMM" not in REGRIDDERS:
-        REGRIDDERS["TRMM"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["TRMM"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-REGRIDDERS = {}
-
-
 def make_seas_plots(fname, lead, enstat, field="precip", yearrange=range(2009, 2013)):
     nmons = 3
     # seas = {12: "DJF", 3: "MAM", 6: "JJA", 9: "SON"}
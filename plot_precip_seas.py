@@ -1,23 +1,36 @@
+import itertools
+import logging
 from calendar import month_abbr
+from dataclasses import dataclass
 from pathlib import Path
 
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
 import colorcet as cc
 import matplotlib.pyplot as plt
 import pandas as pd
 import xarray as xr
-import xesmf as xe
-from joblib import Memory
 
-from utils import get_cmap, get_lon_lat
+from analysis_cache import AnalysisCache
+from climatology import Climatology
+from ensemble import member_median
+from forecast_index import ForecastIndex
+from regrid import regrid
+from render import draw_map, lambert_conformal, prepare_map, render_figures
+from utils import get_cmap, grid_fingerprint
+
+logger = logging.getLogger(__name__)
 
 fname = Path(__file__).stem
-memory = Memory("cache")
+memory = AnalysisCache()
 
 
-@memory.cache
+@memory.cache(
+    inputs=[
+        "/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINNC.nc",
+        "/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINC.nc",
+    ],
+)
 def ymonmean_precip_wrfapseas(
+    exp_name: str,
     month: int,
     lead: int,
     ensstat: str = "median",
@@ -31,11 +44,11 @@ def ymonmean_precip_wrfapseas(
     assert lead + nmons - 1 < 6
 
     ds_nc = xr.open_dataset(
-        "/scratch/athippp/cylc-archive/WRF8kmSEAS_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINNC.nc",
+        f"/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINNC.nc",
         chunks={},
     )["RAINNC"]
     ds_c = xr.open_dataset(
-        "/scratch/athippp/cylc-archive/WRF8kmSEAS_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINC.nc",
+        f"/scratch/athippp/cylc-archive/{exp_name}_H200911/20091102T0000Z/mem1/outputs/wrf2d_RAINC.nc",
         chunks={},
     )["RAINC"]
     ds = ds_nc + ds_c
@@ -53,7 +66,6 @@ def ymonmean_precip_wrfapseas(
     return ds
 
 
-@memory.cache
 def ymonmean_precip_apseas(
     month: int,
     lead: int,
@@ -67,25 +79,17 @@ def ymonmean_precip_apseas(
     assert nmons > 0 and nmons < 6
     assert lead + nmons - 1 < 6
 
-    ds = xr.open_zarr(f"data/ap84SeasRF/{field}.zarr.zip")[field]
     forecast_month = month - lead
     if forecast_month < 1:
         forecast_month += 12
 
-    Times = slice(lead - 1, lead + nmons - 1)
-    ds = ds.sel(forecast=[year in list(yearrange) for year in ds.forecast.dt.year])
-    ds = ds.sel(forecast=ds.forecast.dt.month == forecast_month).isel(Times=Times)
-    ds = ds.isel(south_north=slice(5, -5), west_east=slice(5, -5))
-    # get DateTimeIndex by adding Times months to forecast.values
-    dates = pd.to_datetime([])
-    print(ds["forecast"].values)
-    for i in range(nmons):
-        dates = dates.union(
-            pd.to_datetime(ds["forecast"].values) + pd.DateOffset(months=lead + i)
-        )
-    ds = ds.mean("Times")
-
-    ds = ens_stat(ensstat, ds)
+    # Ensemble statistics are precomputed per lead window by Climatology.update
+    clim = Climatology(f"data/ap84SeasRF/{field}.zarr.zip", field)
+    stat = ensstat if ensstat in ("mean", "median") else "mem1"
+    ds = clim.select(forecast_month, lead, nmons, stat, yearrange)
+    ds = ds.isel(south_north=slice(5, -5), west_east=slice(5, -5)).load()
+    index = ForecastIndex.of(clim.source())
+    dates = index.valid_dates(index.select(forecast_month, lead, nmons, yearrange))
     return ds, dates
 
 
@@ -93,21 +97,23 @@ def ens_stat(ensstat, ds):
     if ensstat == "mean":
         ds = ds.mean("member").mean("forecast")
     elif ensstat == "median":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     else:
         ds = ds.isel(member=0).mean("forecast")
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
-def ymonmean_precip_seas5(
+@memory.cache(inputs=["/project/k10035/athippp/DATA/SEAS5/monthly/precip.zarr.zip"])
+def lead_mean_seas5(
     month: int,
     lead: int,
-    to_grid: xr.Dataset,
-    ensstat: str = "median",
     nmons: int = 1,
     yearrange=range(2009, 2013),
 ):
+    """
+    Lead-window mean of every SEAS5 member and forecast, from which every
+    ensemble statistic is taken.
+    """
     assert lead > 0 and lead < 6
     assert month > 0 and month < 13
     ds = xr.open_zarr("/project/k10035/athippp/DATA/SEAS5/monthly/precip.zarr.zip")[
@@ -117,23 +123,29 @@ def ymonmean_precip_seas5(
     if forecast_month < 1:
         forecast_month += 12
 
-    Times = slice(lead - 1, lead + nmons - 1)
-    ds = ds.sel(forecast=[year in list(yearrange) for year in ds.forecast.dt.year])
-    ds = (
-        ds.sel(forecast=ds.forecast.dt.month == forecast_month)
-        .isel(step=Times)
-        .mean("step")
-    )
+    # SEAS5 monthly means start with the initialisation month
+    index = ForecastIndex.of(ds, "step", lead_offset=0)
+    ds = ds.isel(index.select(forecast_month, lead, nmons, yearrange)).mean("step")
+    return ds.load()
+
+
+def ymonmean_precip_seas5(
+    month: int,
+    lead: int,
+    to_grid: xr.Dataset,
+    ensstat: str = "median",
+    nmons: int = 1,
+    yearrange=range(2009, 2013),
+):
+    ds = lead_mean_seas5(month, lead, nmons, yearrange)
     ds = ens_stat(ensstat, ds)
     ds = ds * 86400 * 30 * 1000  # convert to mm/month
     ds.load()
-    if "SEAS5" not in REGRIDDERS:
-        REGRIDDERS["SEAS5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["SEAS5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(inputs=["obs_data/era5_surface_fields.nc"], grids=["to_grid"])
 def ymonmean_precip_era5(dates, to_grid):
     yearmons = [(dt.year, dt.month) for dt in dates]
     print(yearmons)
@@ -149,13 +161,14 @@ def ymonmean_precip_era5(dates, to_grid):
     ds = ds.mean("time")
     ds = ds * 86400 * 30  # convert to mm/month
     ds.load()
-    if "ERA5" not in REGRIDDERS:
-        REGRIDDERS["ERA5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["ERA5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(
+    inputs=["/project/k10035/athippp/DATA/TRMM/monthly/trmm_2000-2019_monthly.nc"],
+    grids=["to_grid"],
+)
 def ymonmean_precip_trmm(dates, to_grid):
     yearmons = [(dt.year, dt.month) for dt in dates]
     print(yearmons)
@@ -171,61 +184,100 @@ def ymonmean_precip_trmm(dates, to_grid):
     ds = ds.mean("time")
     ds = ds * 30  # convert to mm/month
     ds.load()
-    if "TRMM" not in REGRIDDERS:
-        REGRIDDERS["TRMM"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["TRMM"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-REGRIDDERS = {}
-
+@dataclass(frozen=True)
+class SeasFigure:
+    """
+    One figure of :func:`make_seas_plots`, with a row per season.
+    """
+
+    lead: int
+    ensstat: str
+    yearrange: range = range(2009, 2013)
+    field: str = "precip"
+    seasons: tuple[tuple[int, str], ...] = ((12, "DJF"),)
+    nmons: int = 3
+
+    @property
+    def title_year(self) -> str:
+        startyear = list(self.yearrange)[0]
+        endyear = list(self.yearrange)[-1]
+        if startyear == endyear:
+            return f"{startyear}"
+        return f"{startyear}-{endyear}"
+
+    def path(self, fname: str) -> str:
+        return (
+            f"{fname}_seas_lead{self.lead}_ens{self.ensstat}_{self.field}_"
+            f"{self.title_year}.png"
+        )
 
-def make_seas_plots(fname, lead, enstat, field="precip", yearrange=range(2009, 2013)):
-    nmons = 3
-    # seas = {12: "DJF", 3: "MAM", 6: "JJA", 9: "SON"}
-    # seas = {12: "DJF", 6: "JJA"}
-    seas = {12: "DJF"}
-    proj = ccrs.LambertConformal(
-        central_longitude=45,
-        central_latitude=27,
-        standard_parallels=(18, 27),
-    )
-    fig, axes1 = plt.subplots(
-        nrows=len(seas),
-        ncols=4,
-        figsize=(5 * 3, 5 * len(seas)),
-        subplot_kw={"projection": proj},
-    )
 
-    for n, (mon, seaname) in enumerate(seas.items()):
-        month = mon
-        if month < 1:
-            month += 12
-        apseas, dates = ymonmean_precip_apseas(
+def seas_panels(figure: SeasFigure, reduced: dict | None = None):
+    """
+    Panels of ``figure`` as (season, {dataset: field}) rows.
+
+    Reductions are looked up in and added to ``reduced`` by their arguments,
+    so that the figures of a batch share them: e.g. the SEAS5 member lead
+    means feed the mean, median and mem0 figures, and ERA5 only depends on
+    the dates and grid.
+    """
+    reduced = {} if reduced is None else reduced
+
+    def get(key, func, *args, **kwargs):
+        if key not in reduced:
+            reduced[key] = func(*args, **kwargs)
+        return reduced[key]
+
+    rows = []
+    lead, nmons, years = figure.lead, figure.nmons, figure.yearrange
+    for month, seaname in figure.seasons:
+        apseas, dates = get(
+            ("apseas", month, lead, figure.ensstat, nmons, figure.field, years),
+            ymonmean_precip_apseas,
             month,
             lead,
-            ensstat=enstat,
+            ensstat=figure.ensstat,
             nmons=nmons,
-            field=field,
-            yearrange=yearrange,
+            field=figure.field,
+            yearrange=years,
         )
-        wrfapseas = ymonmean_precip_wrfapseas(
+        grid = grid_fingerprint(apseas)
+        wrfapseas = get(
+            ("wrfapseas", month, lead, figure.ensstat, nmons, figure.field, years),
+            ymonmean_precip_wrfapseas,
+            "WRF8kmSEAS",
             month,
             lead,
-            ensstat=enstat,
+            ensstat=figure.ensstat,
             nmons=nmons,
-            field=field,
-            yearrange=yearrange,
+            field=figure.field,
+            yearrange=years,
         )
-        seas5 = ymonmean_precip_seas5(
+        members = get(
+            ("seas5_members", month, lead, nmons, years),
+            lead_mean_seas5,
             month,
             lead,
+            nmons,
+            years,
+        )
+        seas5 = get(
+            ("seas5", month, lead, nmons, years, figure.ensstat, grid),
+            lambda: regrid(
+                (ens_stat(figure.ensstat, members) * 86400 * 30 * 1000).load(),
+                apseas,
+            ),
+        )
+        era5 = get(
+            ("era5", tuple(dates), grid),
+            ymonmean_precip_era5,
+            dates,
             to_grid=apseas,
-            ensstat=enstat,
-            nmons=nmons,
-            yearrange=yearrange,
         )
-        era5 = ymonmean_precip_era5(dates, to_grid=apseas)
         # trmm = ymonmean_precip_trmm(dates, to_grid=apseas)
 
         data_dict = {
@@ -235,57 +287,91 @@ def make_seas_plots(fname, lead, enstat, field="precip", yearrange=range(2009, 2
             "ERA5": era5,
             #    "TRMM": trmm,
         }
-        levels = [1, 3, 6, 9, 12, 16, 20, 25, 30, 40, 50, 75, 100, 150]
-        cmap, norm = get_cmap(levels, cc.cm["rainbow4"], extend="max")
+        rows.append((seaname, {k: v.load() for k, v in data_dict.items()}))
+    return rows
+
+
+def render_seas_figure(path: str, figure: SeasFigure, rows):
+    proj = lambert_conformal()
+    fig, axes1 = plt.subplots(
+        nrows=len(rows),
+        ncols=4,
+        figsize=(5 * 3, 5 * len(rows)),
+        subplot_kw={"projection": proj},
+        squeeze=False,
+    )
+    levels = [1, 3, 6, 9, 12, 16, 20, 25, 30, 40, 50, 75, 100, 150]
+    cmap, norm = get_cmap(levels, cc.cm["rainbow4"], extend="max")
+    for n, (seaname, data_dict) in enumerate(rows):
         axes = axes1[n, :]
         for i, (dname, data) in enumerate(data_dict.items()):
-            print(dname)
             # Model data for the given month
             ax = axes[i]
-            lon, lat = get_lon_lat(data)
-            values = data.values
-            cs = ax.pcolormesh(
-                lon,
-                lat,
-                values,
-                transform=ccrs.PlateCarree(),
-                cmap=cmap,
-                norm=norm,
-            )
-
-            ax.coastlines()
-            ax.add_feature(cfeature.BORDERS)
+            cs = draw_map(ax, data, cmap, norm)
             ax.set_title(dname, loc="left")
             ax.set_title(seaname, loc="right")
 
     cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])
-    startyear = list(yearrange)[0]
-    endyear = list(yearrange)[-1]
-    title_year = f"{startyear}-{endyear}"
-    if startyear == endyear:
-        title_year = f"{startyear}"
+    title_year = figure.title_year
     fig.suptitle(
-        f"Rainfall {title_year} (Lead {lead})"
+        f"Rainfall {title_year} (Lead {figure.lead})"
     )  # Add a single colorbar for all subplots
     plt.colorbar(
         cs,
         cax=cbar_ax,
         label=f"Rainfall (mm) - {title_year} ",
     )
-    plt.savefig(f"{fname}_seas_lead{lead}_ens{enstat}_{field}_{title_year}.png")
-    plt.gca()
-    plt.gcf()
-    plt.close()
+    plt.savefig(path)
+    plt.close(fig)
+    return path
+
+
+def make_seas_plots(fname, lead, enstat, field="precip", yearrange=range(2009, 2013)):
+    figure = SeasFigure(lead, enstat, yearrange, field)
+    render_seas_figure(figure.path(fname), figure, seas_panels(figure))
+
+
+def make_seas_plots_batch(
+    fname,
+    leads=(1,),
+    ensstats=("mean", "median", "mem0"),
+    yearranges=(range(2009, 2013),),
+    fields=("precip",),
+    seasons=((12, "DJF"),),
+    max_workers=None,
+):
+    """
+    Render a figure for every combination of ``leads``, ``ensstats``,
+    ``yearranges`` and ``fields``, with a row per season of ``seasons``.
+
+    The data of all figures are reduced first in this process, each shared
+    reduction once, and the figures are then rendered in a process pool by
+    :func:`render.render_figures`.
+    """
+    figures = [
+        SeasFigure(lead, ensstat, yearrange, field, tuple(seasons))
+        for lead, ensstat, yearrange, field in itertools.product(
+            leads, ensstats, yearranges, fields
+        )
+    ]
+    reduced = {}
+    panels = [seas_panels(figure, reduced) for figure in figures]
+    logger.info(f"{len(figures)} figures from {len(reduced)} reductions")
+    # Projected once here, so that the workers load them from the disk caches
+    grids = {grid_fingerprint(d): d for _, row in panels[0] for d in row.values()}
+    for data in grids.values():
+        prepare_map(data, lambert_conformal())
+    render_figures(
+        render_seas_figure,
+        [(figure.path(fname), figure, rows) for figure, rows in zip(figures, panels)],
+        max_workers,
+    )
 
 
 def plot_c2nc_ratio_apseas(fname, lead, enstat):
     nmons = 3
     seas = {12: "DJF", 3: "MAM", 6: "JJA", 9: "SON"}
-    proj = ccrs.LambertConformal(
-        central_longitude=45,
-        central_latitude=27,
-        standard_parallels=(18, 27),
-    )
+    proj = lambert_conformal()
     fig, axes1 = plt.subplots(
         nrows=2,
         ncols=2,
@@ -310,19 +396,7 @@ def plot_c2nc_ratio_apseas(fname, lead, enstat):
         data = (precipc / precip) * 100.0
 
         ax = axes[n]
-        lon, lat = get_lon_lat(data)
-        values = data.values
-        cs = ax.pcolormesh(
-            lon,
-            lat,
-            values,
-            transform=ccrs.PlateCarree(),
-            cmap=cmap,
-            norm=norm,
-        )
-
-        ax.coastlines()
-        ax.add_feature(cfeature.BORDERS)
+        cs = draw_map(ax, data, cmap, norm)
         ax.set_title(seaname, loc="right")
 
     fig.suptitle(
@@ -341,7 +415,11 @@ def plot_c2nc_ratio_apseas(fname, lead, enstat):
 
 
 if __name__ == "__main__":
-    lead = 1
-    enstat = "mem0"
-    make_seas_plots(fname, lead, enstat, yearrange=range(2009, 2013))
+    logging.basicConfig(level=logging.INFO)
+    make_seas_plots_batch(
+        fname,
+        leads=[1],
+        ensstats=["mem0"],
+        yearranges=[range(2009, 2013)],
+    )
     # plot_c2nc_ratio_apseas("convetive2total_ratio_apseas", lead, enstat)
@@ -8,16 +8,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import xarray as xr
-import xesmf as xe
-from joblib import Memory
 
+from analysis_cache import AnalysisCache
+from ensemble import member_median
+from regrid import regrid
 from utils import calculate_colormap_range, get_cmap, get_lon_lat
 
 fname = Path(__file__).stem
-memory = Memory("cache")
+memory = AnalysisCache()
 
 
-@memory.cache
+@memory.cache(inputs=["data/ap84SeasRF/{field}.zarr.zip"])
 def ymonmean_precip_apseas(
     month: int,
     lead: int,
@@ -48,13 +49,16 @@ def ymonmean_precip_apseas(
         )
     ds = ds.mean("Times")
     if ensstat == "mean":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     else:
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     return ds, dates
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(
+    inputs=["/project/k10035/athippp/DATA/SEAS5/monthly/precip.zarr.zip"],
+    grids=["to_grid"],
+)
 def ymonmean_precip_seas5(
     month: int,
     lead: int,
@@ -81,14 +85,12 @@ def ymonmean_precip_seas5(
         .mean("step")
     )
     if ensstat == "mean":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     else:
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     ds = ds * 86400 * 30 * 1000  # convert to mm/month
     ds.load()
-    if "SEAS5" not in REGRIDDERS:
-        REGRIDDERS["SEAS5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["SEAS5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
@@ -106,15 +108,10 @@ def ymonmean_precip_era5(yearmons, to_grid):
     ds = ds.mean("time")
     ds = ds * 86400 * 30  # convert to mm/month
     ds.load()
-    if "SEAS5" not in REGRIDDERS:
-        REGRIDDERS["SEAS5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["SEAS5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-REGRIDDERS = {}
-
-
 def main():
     proj = ccrs.LambertConformal(
         central_longitude=45,
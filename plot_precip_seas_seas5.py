@@ -8,16 +8,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import xarray as xr
-import xesmf as xe
-from joblib import Memory
 
+from analysis_cache import AnalysisCache
+from ensemble import member_median
+from regrid import regrid
 from utils import calculate_colormap_range, get_cmap, get_lon_lat
 
 fname = Path(__file__).stem
-memory = Memory("cache")
+memory = AnalysisCache()
 
 
-@memory.cache
+@memory.cache(inputs=["data/ap84SeasRF/{field}.zarr.zip"])
 def ymonmean_precip_apseas(
     month: int,
     lead: int,
@@ -50,9 +51,9 @@ def ymonmean_precip_apseas(
         )
     ds = ds.mean("Times")
     if ensstat == "mean":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     elif ensstat == "median":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     elif ensstat == "max":
         ds = ds.max("member").mean("forecast")
     elif ensstat == "min":
@@ -62,7 +63,10 @@ def ymonmean_precip_apseas(
     return ds, dates
 
 
-@memory.cache(ignore=["to_grid"])
+@memory.cache(
+    inputs=["/project/k10035/athippp/DATA/SEAS5/monthly/precip.zarr.zip"],
+    grids=["to_grid"],
+)
 def ymonmean_precip_seas5(
     month: int,
     lead: int,
@@ -89,20 +93,15 @@ def ymonmean_precip_seas5(
         .mean("step")
     )
     if ensstat == "mean":
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     else:
-        ds = ds.median("member").mean("forecast")
+        ds = member_median(ds).mean("forecast")
     ds = ds * 86400 * 30 * 1000  # convert to mm/month
     ds.load()
-    if "SEAS5" not in REGRIDDERS:
-        REGRIDDERS["SEAS5"] = xe.Regridder(ds, to_grid, "bilinear")
-    ds = REGRIDDERS["SEAS5"](ds)
+    ds = regrid(ds, to_grid)
     return ds
 
 
-REGRIDDERS = {}
-
-
 def main():
     proj = ccrs.LambertConformal(
         central_longitude=45,
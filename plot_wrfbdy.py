@@ -1,76 +1,149 @@
+"""
+Diagnostics of the WRF lateral boundary files (``wrfbdy_d01``) of members.
+
+    python plot_wrfbdy.py --exp ap84SeasRF --date 20090102T0000Z --members 1 2
+
+Every boundary variable (``_BXS``, ``_BXE``, ``_BYS``, ``_BYE`` and their
+``_BT..`` tendencies) of every member is summarised in one dask pass over
+the chunked files: its minimum, maximum, 2nd and 98th percentiles and
+whether it is constant. The summaries are written to ``wrfbdy_summary.csv``
+and the first time of the non-constant variables is plotted in a process
+pool, with the colour range of the summary.
+"""
+
+import argparse
+import logging
+import re
+from pathlib import Path
+
 import colorcet as cc
+import dask
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import xarray as xr
 
-from utils import calculate_colormap_range, get_cmap
-
-ds = xr.open_dataset(
-    "/scratch/athippp/cylc-run/ap84SeasRF/run1/work/20090102T0000Z/share/mem1/wrfbdy_d01"
-)
-
-data_var_names = [str(v) for v in ds.data_vars if str(v).endswith("_BXS")]
-bdy_width = 5
-for vname in data_var_names:
-    print(f"{vname}")
-    if len(ds[vname].shape) != 4:
-        continue
-    dvar = ds[vname][0, :, :, :]
-    if np.all(dvar == dvar[0, 0, 0]):
-        print(f"{vname} - All values are: {dvar[0,0,0].values}")
-        continue
+from render import render_figures
+from utils import get_cmap, quantile_digest
+
+logger = logging.getLogger(__name__)
+
+WRFBDY = "/scratch/athippp/cylc-run/{exp}/run1/work/{date}/share/mem{mem}/wrfbdy_d01"
+BOUNDARY = re.compile(r"_BT?[XY][SE]$")
+
+
+def boundary_vars(ds: xr.Dataset) -> list[str]:
+    return [str(v) for v in ds.data_vars if BOUNDARY.search(str(v))]
+
+
+def summarise(paths: dict[int, str], low=2, high=98) -> pd.DataFrame:
+    """
+    Statistics of every boundary variable of the ``paths`` of the members,
+    over all times, computed in one pass.
+    """
+    digests, attrs = {}, {}
+    for mem, path in paths.items():
+        ds = xr.open_dataset(path, chunks={"Time": 1})
+        for vname in boundary_vars(ds):
+            digests[mem, vname] = quantile_digest(ds[vname], compute=False)
+            attrs[mem, vname] = ds[vname].attrs
+    (digests,) = dask.compute(digests)
+    rows = []
+    for (mem, vname), digest in digests.items():
+        row = {
+            "member": mem,
+            "variable": vname,
+            "description": attrs[mem, vname].get("description", ""),
+            "units": attrs[mem, vname].get("units", ""),
+        }
+        if digest is None:
+            row.update(min=np.nan, max=np.nan, low=np.nan, high=np.nan)
+        else:
+            row.update(
+                min=digest.vmin,
+                max=digest.vmax,
+                low=digest.percentile(low),
+                high=digest.percentile(high),
+            )
+        row["constant"] = digest is not None and digest.vmin == digest.vmax
+        rows.append(row)
+    return pd.DataFrame(rows).rename(columns={"low": f"p{low}", "high": f"p{high}"})
+
+
+def plot_variable(path: str, vname: str, vmin: float, vmax: float, out: str) -> str:
+    """
+    Plot the first time of ``vname``, one panel per boundary row for
+    (bdy_width, bottom_top, along-edge) variables.
+    """
+    with xr.open_dataset(path) as ds:
+        dvar = ds[vname].isel(Time=0).load()
+    panels = dvar.values if dvar.ndim == 3 else dvar.values[None]
     fig, axes = plt.subplots(
-        nrows=5,
-        ncols=1,
-        figsize=(15, 15),
+        nrows=len(panels), ncols=1, figsize=(15, 15), squeeze=False
     )
-    vmin, vmax = calculate_colormap_range(dvar.values)
     cmap, norm = get_cmap(np.linspace(vmin, vmax, 30), cc.cm["rainbow4"])
-    for bd in range(bdy_width):
-        print(f"{vname} - {bd}")
-        var = dvar[bd, :, :].values
+    for ax, var in zip(axes[:, 0], panels):
         x = np.arange(var.shape[1] + 1)
         y = np.arange(var.shape[0] + 1)
-        cs = axes[bd].pcolormesh(x, y, var, cmap=cmap, norm=norm)
+        cs = ax.pcolormesh(x, y, var, cmap=cmap, norm=norm)
 
-    plt.suptitle(f"{dvar.attrs["description"]} - {dvar.attrs["units"]}")
+    plt.suptitle(f"{dvar.attrs['description']} - {dvar.attrs['units']}")
     cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])
     plt.colorbar(
         cs,
         cax=cbar_ax,
     )
 
-    plt.savefig(f"{vname}_SEAS5_bdy.png")
+    Path(out).parent.mkdir(parents=True, exist_ok=True)
+    plt.savefig(out)
     plt.close()
+    return out
 
-for vname in data_var_names:
-    print(f"{vname}")
-    if len(ds[vname].shape) == 4:
-        continue
 
-    dvar = ds[vname][0, :, :]
-    if np.all(dvar == dvar[0, 0]):
-        print(f"{vname} - All values are: {dvar[0,0].values}")
-        continue
-    fig, axes = plt.subplots(
-        nrows=1,
-        ncols=1,
-        figsize=(15, 15),
-    )
-    vmin, vmax = calculate_colormap_range(dvar.values)
-    cmap, norm = get_cmap(np.linspace(vmin, vmax, 30), cc.cm["rainbow4"])
-    print(f"{vname} - {bd}")
-    var = dvar[:, :].values
-    x = np.arange(var.shape[1] + 1)
-    y = np.arange(var.shape[0] + 1)
-    cs = axes.pcolormesh(x, y, var, cmap=cmap, norm=norm)
+def check_members(
+    exp: str,
+    date: str,
+    members,
+    output: str = "wrfbdy",
+    plot: bool = True,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    paths = {mem: WRFBDY.format(exp=exp, date=date, mem=mem) for mem in members}
+    summary = summarise(paths)
+    Path(output).mkdir(parents=True, exist_ok=True)
+    summary.to_csv(Path(output) / "wrfbdy_summary.csv", index=False)
+    for row in summary[summary["constant"]].itertuples():
+        logger.info(f"mem{row.member} {row.variable} - All values are: {row.min}")
+    if plot:
+        varying = summary[~summary["constant"] & summary["min"].notna()]
+        jobs = [
+            (
+                paths[row.member],
+                row.variable,
+                # Mostly uniform variables: colour the whole range
+                *((row.p2, row.p98) if row.p2 < row.p98 else (row.min, row.max)),
+                f"{output}/mem{row.member}/{row.variable}_SEAS5_bdy.png",
+            )
+            for row in varying.itertuples()
+        ]
+        if jobs:
+            render_figures(plot_variable, jobs, max_workers)
+    return summary
 
-    plt.suptitle(f"{dvar.attrs["description"]} - {dvar.attrs["units"]}")
-    cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])
-    plt.colorbar(
-        cs,
-        cax=cbar_ax,
-    )
 
-    plt.savefig(f"{vname}_SEAS5_bdy.png")
-    plt.close()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--exp", default="ap84SeasRF")
+    parser.add_argument("--date", default="20090102T0000Z")
+    parser.add_argument("--members", type=int, nargs="+", default=range(1, 26))
+    parser.add_argument("--output", default="wrfbdy")
+    parser.add_argument("--no-plots", dest="plot", action="store_false")
+    parser.add_argument("--max-workers", type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    summary = check_members(**vars(args))
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
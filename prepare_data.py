@@ -4,14 +4,17 @@ import glob
 import logging
 import multiprocessing
 import os
-import shutil
 import sys
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
 
 from cdo import Cdo
 
+from cdo_cache import input_files, publish, single_flight
+from ensemble import ens_stats, tercile_edges
+from taskgraph import Task, run_graph
+
 cdo = Cdo(tempdir="tmp", silent=False)
 
 logging.basicConfig(
@@ -34,16 +37,38 @@ class DataStore:
         return sorted([d.split("/")[-1] for d in dirs])
 
 
+def is_up_to_date(output, input):
+    if not Path(output).exists():
+        return False
+    mtime = Path(output).stat().st_mtime_ns
+    return all(os.stat(path).st_mtime_ns <= mtime for path in input_files(input))
+
+
+def all_up_to_date(outputs, input):
+    return all(is_up_to_date(output, input) for output in outputs)
+
+
 def cdo_execute(input, output="", options=""):
-    if output and Path(output).exists():
-        logging.info(f"Output exists. Not Executing: cdo {options} {input} {output}")
+    if output and is_up_to_date(output, input):
+        logging.info(f"Output up to date. Not Executing: cdo {options} {input} {output}")
         return output
+    if not output:
+        return _cdo_run(input, output, options)
+    create_parent_directory(output)
+    with single_flight(output):
+        # Another worker may have written the output while this one waited
+        if is_up_to_date(output, input):
+            logging.info(f"Written by another worker: {output}")
+            return output
+        return _cdo_run(input, output, options)
+
+
+def _cdo_run(input, output, options):
     logging.info(f"Executing: cdo {options} {input} {output}")
     res = cdo.copy(input=input, options=options)
     logging.info(f"Done: cdo {options} {input} {res}")
     if output:
-        create_parent_directory(output)
-        shutil.move(res, output)
+        publish(res, output)
         logging.info(f"Moved  {res} -> {output}")
         res = output
     return res
@@ -52,105 +77,171 @@ def create_parent_directory(path: str):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
 
 @dataclass
-class ProcessPr:
+class FieldRecipe:
+    """
+    How the monthly field is derived from the WRF output of one member.
+
+    cdo_opr is formatted with fld and the path of each wrf2d_<source>.nc
+    """
+    fld: str
+    sources: list[str]
+    cdo_opr: str
+
+
+def _rate(infile):
+    return f"-sub -seltimestep,2/-1 {infile} -seltimestep,1/-2 {infile}"
+
+
+PR = FieldRecipe(
+    fld="pr",
+    sources=["RAINNC", "RAINC"],
+    cdo_opr="-setattribute,{fld}@units=mm/sec -chname,RAINNC,{fld} -monmean -divc,3600 "
+    + _rate("-add {RAINNC} {RAINC}"),
+)
+T2 = FieldRecipe(fld="t2", sources=["T2"], cdo_opr="-chname,T2,{fld} -monmean {T2}")
+
+
+@dataclass
+class ProcessField:
     idata_store: DataStore
     data_cache: str
-    fld: str = "pr"
+    recipe: FieldRecipe
+    members: range = range(1, 26)
+    ensstats: tuple = ("mean", "median", "std", "p10", "p90")
+    # Tercile probabilities need the edges of every forecast of the init month,
+    # so the statistics of a forecast then wait for all of them
+    terciles: bool = False
+
+    @property
+    def fld(self):
+        return self.recipe.fld
+
     def get_input_file_path(self, fcstdate, mem, fld):
         return f"{self.idata_store.data_root}/{self.idata_store.exp_name}/{fcstdate}/mem{mem}/outputs/wrf2d_{fld}.nc"
     
     def get_output_file_path(self, fcstdate, ens, fld):
         return f"{self.data_cache}/{self.idata_store.exp_name}/{fcstdate}/monthly/{ens}/{fld}.nc"
+
+    def get_edges_file_path(self, init_month):
+        return f"{self.data_cache}/{self.idata_store.exp_name}/terciles/{init_month}/{self.fld}.nc"
     
-     
-    def mon_mean(self):
-        options="-r"
-        inputs = []
-        outputs = []
-        res = {}
+    def cdo_task(self, input, output, deps=(), options="-r"):
+        return Task(
+            target=output,
+            func=cdo_execute,
+            args=(input, output, options),
+            deps=list(deps),
+            is_current=partial(is_up_to_date, output, input),
+        )
+
+    def mon_mean_tasks(self):
+        tasks = []
         for date in self.idata_store.get_fcst_dates():
-            res[date] = {}
-            for mem in range(1, 26):
-                inputs.append(self.get_input(date, mem))
-                outputs.append(self.get_output(date, mem))
-                
-        # multiprocessing.set_start_method("fork", force=True)
-        workers = min(os.cpu_count()-2, len(inputs))
-        logging.info(f"Using {workers} workers")
-        with ProcessPoolExecutor(max_workers=workers) as executor:
-            executor.map(
-                cdo_execute,
-                inputs,
-                outputs,
-                [options] * len(inputs),
+            for mem in self.members:
+                tasks.append(self.cdo_task(self.get_input(date, mem), self.get_output(date, mem)))
+        return tasks
+
+    def dates_by_init_month(self):
+        months = {}
+        for date in self.idata_store.get_fcst_dates():
+            months.setdefault(date[4:6], []).append(date)
+        return months
+
+    def tercile_edges_tasks(self):
+        tasks = []
+        for init_month, dates in self.dates_by_init_month().items():
+            members = [self.get_output(date, mem) for date in dates for mem in self.members]
+            output = self.get_edges_file_path(init_month)
+            tasks.append(
+                Task(
+                    target=output,
+                    func=tercile_edges,
+                    args=(members, output, self.fld),
+                    deps=members,
+                    is_current=partial(is_up_to_date, output, " ".join(members)),
+                )
             )
-            
-    def ens_stat(self, opr):
-        opr_safe = opr.replace(",", "")
-        options="-r"
-        inputs = []
-        outputs = []
+        return tasks
+
+    def ens_stats_tasks(self):
+        # All statistics of a forecast come from one read of its members
+        tasks = []
         for date in self.idata_store.get_fcst_dates():
-            input=f"-ens{opr} [ "
-            for mem in range(1, 26):
-                input = input + self.get_output(date, mem) + " "
-            input = input + " ] "
-            inputs.append(input)
-            outputs.append(self.get_output_file_path(date, f"ens{opr_safe}", "pr"))
-                
-        # multiprocessing.set_start_method("fork", force=True)
-        workers = min(os.cpu_count()-2, len(inputs))
-        logging.info(f"Using {workers} workers")
-        with ProcessPoolExecutor(max_workers=workers) as executor:
-            executor.map(
-                cdo_execute,
-                inputs,
-                outputs,
-                [options] * len(inputs),
+            members = [self.get_output(date, mem) for mem in self.members]
+            outputs = {
+                stat: self.get_output_file_path(date, f"ens{stat}", self.fld)
+                for stat in self.ensstats
+            }
+            edges = None
+            if self.terciles:
+                edges = self.get_edges_file_path(date[4:6])
+                outputs["terciles"] = self.get_output_file_path(date, "terciles", self.fld)
+            inputs = members + ([edges] if edges else [])
+            target, *others = outputs.values()
+            tasks.append(
+                Task(
+                    target=target,
+                    func=ens_stats,
+                    args=(members, outputs, self.fld, edges),
+                    deps=inputs,
+                    is_current=partial(all_up_to_date, list(outputs.values()), " ".join(inputs)),
+                    outputs=others,
+                )
             )
-            
-    def ymonmean(self, lead_months=range(1, 7), ensstats=["median", "mean"]):
-        options="-r"
-        inputs = []
-        outputs = []
+        return tasks
+
+    def ymonmean_tasks(self, lead_months=range(1, 7), ensstats=["median", "mean"]):
+        tasks = []
         for lead_month in lead_months:
             for ensstat in ensstats:
+                ens_outputs = [
+                    self.get_output_file_path(date, f"ens{ensstat}", self.fld)
+                    for date in self.idata_store.get_fcst_dates()
+                ]
                 input = "-ymonmean -mergetime [ "
-                for date in self.idata_store.get_fcst_dates():
-                    input = input + f" -seltimestep,{lead_month+1} " + self.get_output_file_path(date, f"ens{ensstat}", self.fld)
-            
+                for ens_output in ens_outputs:
+                    input = input + f" -seltimestep,{lead_month+1} " + ens_output
                 input = input + " ] "
-                inputs.append(input)
                 output = f"{self.data_cache}/{self.idata_store.exp_name}/ymonmean/lead{lead_month}/ens{ensstat}/{self.fld}.nc"
-                outputs.append(output)
-                
-        # multiprocessing.set_start_method("fork", force=True)
-        workers = min(os.cpu_count()-2, len(inputs))
-        logging.info(f"Using {workers} workers")
-        with ProcessPoolExecutor(max_workers=workers) as executor:
-            executor.map(
-                cdo_execute,
-                inputs,
-                outputs,
-                [options] * len(inputs),
-            )
+                tasks.append(self.cdo_task(input, output, deps=ens_outputs))
+        return tasks
+
+    def tasks(self, ymonmean_stats=["median", "mean"]):
+        tasks = self.mon_mean_tasks() + self.ens_stats_tasks() + self.ymonmean_tasks(ensstats=ymonmean_stats)
+        if self.terciles:
+            tasks += self.tercile_edges_tasks()
+        return tasks
+
+    def run(self, ymonmean_stats=["median", "mean"]):
+        # Each file is computed as soon as its inputs are, across all stages
+        run_graph(self.tasks(ymonmean_stats))
+
+    def mon_mean(self):
+        run_graph(self.mon_mean_tasks())
+
+    def ens_stats(self):
+        tasks = self.ens_stats_tasks()
+        if self.terciles:
+            tasks = self.tercile_edges_tasks() + tasks
+        run_graph(tasks)
+
+    def ymonmean(self, lead_months=range(1, 7), ensstats=["median", "mean"]):
+        run_graph(self.ymonmean_tasks(lead_months, ensstats))
 
     def get_input(self, date, mem):
-        infile1 = self.get_input_file_path(date, mem, "RAINNC")
-        infile2 = self.get_input_file_path(date, mem, "RAINC")
-        infile = f"-add {infile1} {infile2}"
-        input=f" -setattribute,{self.fld}@units=mm/sec -chname,RAINNC,{self.fld} -monmean -divc,3600 -sub -seltimestep,2/-1 {infile} -seltimestep,1/-2 {infile}"
-        return input
+        files = {src: self.get_input_file_path(date, mem, src) for src in self.recipe.sources}
+        return " " + self.recipe.cdo_opr.format(fld=self.fld, **files)
+
     def get_output(self, date, mem):
         return self.get_output_file_path(date, f"mem{mem}", self.fld)
-    
 
-    
+
+@dataclass
+class ProcessPr(ProcessField):
+    recipe: FieldRecipe = field(default_factory=lambda: PR)
+
 
 if __name__ == "__main__":
     data_store = DataStore(data_root="/scratch/athippp/cylc-archive", exp_name="ap84SeasRF")
     pr = ProcessPr(idata_store=data_store, data_cache="data_cache")
-    pr.mon_mean() 
-    pr.ens_stat("mean")
-    pr.ens_stat("median")
-    pr.ymonmean()
\ No newline at end of file
+    pr.run()
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+Regridding with bilinear (or other xESMF) weights cached on disk.
+
+Weights are stored as ``<cache_dir>/<method>_<source>_<target>.nc``, keyed by
+fingerprints of the source and target longitudes and latitudes, so that
+every script and process reuses them instead of rebuilding them with ESMF.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import xarray as xr
+import xesmf as xe
+
+from utils import grid_fingerprint
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "cache/regrid"
+
+_REGRIDDERS: dict[str, xe.Regridder] = {}
+
+
+def get_regridder(
+    ds_in: xr.Dataset | xr.DataArray,
+    ds_out: xr.Dataset | xr.DataArray,
+    method: str = "bilinear",
+    cache_dir: str = CACHE_DIR,
+) -> xe.Regridder:
+    """
+    Regridder from the grid of ``ds_in`` to the grid of ``ds_out``.
+
+    The weights are read from ``cache_dir`` if another run already built
+    them, otherwise they are built and saved there.
+    """
+    path = Path(cache_dir) / (
+        f"{method}_{grid_fingerprint(ds_in)}_{grid_fingerprint(ds_out)}.nc"
+    )
+    key = str(path)
+    if key in _REGRIDDERS:
+        return _REGRIDDERS[key]
+    if path.exists():
+        regridder = xe.Regridder(ds_in, ds_out, method, weights=str(path))
+    else:
+        logger.info(f"Building {method} regridding weights {path}")
+        regridder = xe.Regridder(ds_in, ds_out, method)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Another process may be writing the same weights
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        regridder.to_netcdf(str(tmp))
+        os.replace(tmp, path)
+    _REGRIDDERS[key] = regridder
+    return regridder
+
+
+def regrid(
+    ds: xr.Dataset | xr.DataArray,
+    to_grid: xr.Dataset | xr.DataArray,
+    method: str = "bilinear",
+) -> xr.Dataset | xr.DataArray:
+    """
+    Regrid ``ds`` onto the grid of ``to_grid``.
+
+    All dimensions other than the horizontal ones (members, forecasts, ...)
+    are regridded together as one sparse matrix product, so stack them into
+    one call rather than regridding fields one at a time.
+    """
+    return get_regridder(ds, to_grid, method)(ds)
@@ -0,0 +1,318 @@
+"""
+Map panels drawn from geometry projected once per projection and grid.
+
+``ax.coastlines()`` and ``ax.add_feature(cfeature.BORDERS)`` reproject the
+Natural Earth geometries for every panel, and ``pcolormesh`` with a
+PlateCarree transform reprojects the mesh of every panel. Here the
+coastlines and borders around a grid are projected once and kept in memory
+and under ``cache/render`` as matplotlib paths, the cell corners of a grid
+are projected once by :func:`utils.grid_mesh`, and panels draw them in the
+axes coordinates directly.
+
+Figures are rendered off-screen in a process pool by :func:`render_figures`,
+and animations by :meth:`Animation.save`, which streams their frames to
+ffmpeg.
+"""
+
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import subprocess
+import typing as t
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import shapely
+import xarray as xr
+from cartopy.mpl.patch import geos_to_path
+from matplotlib.axes import Axes
+from matplotlib.collections import PathCollection
+
+from utils import detect_time_dimension, get_grid, grid_mesh, mesh_dims
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "cache/render"
+
+
+@functools.cache
+def lambert_conformal() -> ccrs.LambertConformal:
+    """
+    Projection of the maps of the Arabian Peninsula domain.
+    """
+    return ccrs.LambertConformal(
+        central_longitude=45,
+        central_latitude=27,
+        standard_parallels=(18, 27),
+    )
+
+
+def _bounds(data: xr.DataArray, pad: float = 5.0) -> tuple[int, ...]:
+    grid = get_grid(data)
+    return (
+        int(np.floor(grid.lon.min() - pad)),
+        int(np.floor(grid.lat.min() - pad)),
+        int(np.ceil(grid.lon.max() + pad)),
+        int(np.ceil(grid.lat.max() + pad)),
+    )
+
+
+@functools.cache
+def background_paths(
+    projection: ccrs.Projection,
+    bounds: tuple[int, int, int, int],
+    resolution: str = "50m",
+    cache_dir: str = CACHE_DIR,
+) -> list:
+    """
+    Coastlines and borders within the lon/lat ``bounds``, projected and
+    converted to matplotlib paths.
+    """
+    key = hashlib.sha1(
+        f"{projection.proj4_init}{bounds}{resolution}".encode()
+    ).hexdigest()[:16]
+    path = Path(cache_dir) / f"background_{key}.pkl"
+    if path.exists():
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    logger.info(f"Projecting coastlines and borders {bounds} to {path}")
+    box = shapely.box(*bounds)
+    paths = []
+    for feature in (
+        cfeature.COASTLINE.with_scale(resolution),
+        cfeature.BORDERS.with_scale(resolution),
+    ):
+        for geom in feature.intersecting_geometries(bounds[::2] + bounds[1::2]):
+            geom = geom.intersection(box)
+            if geom.is_empty:
+                continue
+            projected = projection.project_geometry(geom, ccrs.PlateCarree())
+            paths.extend(geos_to_path(projected))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(paths, f)
+    os.replace(tmp, path)
+    return paths
+
+
+def draw_map(ax, data: xr.DataArray, cmap, norm, linewidth: float = 1.0):
+    """
+    ``pcolormesh`` of ``data`` with coastlines and borders on a GeoAxes.
+
+    Replaces ``ax.pcolormesh(lon, lat, values, transform=PlateCarree())``
+    followed by ``ax.coastlines()`` and ``ax.add_feature(cfeature.BORDERS)``.
+    """
+    x, y = grid_mesh(data, ax.projection)
+    values = data.transpose(..., *mesh_dims(data)).values
+    # The mesh is already projected: skip the reprojection and wrapping
+    # checks of GeoAxes.pcolormesh
+    cs = Axes.pcolormesh(ax, x, y, values, cmap=cmap, norm=norm)
+    paths = background_paths(ax.projection, _bounds(data))
+    ax.add_collection(
+        PathCollection(
+            paths,
+            facecolor="none",
+            edgecolor="black",
+            linewidth=linewidth,
+            transform=ax.transData,
+        ),
+        autolim=False,
+    )
+    return cs
+
+
+def prepare_map(data: xr.DataArray, projection: ccrs.Projection):
+    """
+    Project the mesh and background of ``data`` in this process, e.g. before
+    starting :func:`render_figures` so that the workers load them from the
+    disk caches instead of each projecting them.
+    """
+    grid_mesh(data, projection)
+    background_paths(projection, _bounds(data))
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def render_figures(
+    func: t.Callable, jobs: list[tuple], max_workers: int | None = None
+) -> list:
+    """
+    Call ``func(*job)`` for every job in a process pool of off-screen
+    (Agg) workers, each saving one figure, and return their results.
+
+    The workers are spawned, as dask usually ran in this process: ``func``
+    must be importable and the calling script guarded by ``__main__``.
+    """
+    max_workers = max_workers or min(len(jobs), max(os.cpu_count() - 2, 1))
+    with ProcessPoolExecutor(
+        max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    ) as executor:
+        futures = {executor.submit(func, *job): n for n, job in enumerate(jobs)}
+        results = [None] * len(jobs)
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            logger.info(f"Rendered {results[futures[future]]}")
+    return results
+
+
+@dataclass
+class Animation:
+    """
+    A map animation of the frames of ``data`` along its time dimension.
+
+    Parameters:
+    - data: lazily read (time, y, x) data; frames are read one at a time
+    - label: colorbar label
+    - title: frame title, formatted with the frame ``time``, e.g.
+      ``"{time:%Y-%m-%d}"``
+    """
+
+    data: xr.DataArray
+    cmap: t.Any
+    norm: t.Any
+    label: str = ""
+    title: str | None = None
+    figsize: tuple[float, float] = (15, 15)
+    dpi: int = 100
+
+    def __post_init__(self):
+        self.time_dim = detect_time_dimension(self.data)
+
+    def __len__(self) -> int:
+        return self.data.sizes[self.time_dim]
+
+    def figure(self):
+        """
+        The figure of the first frame, with the QuadMesh updated by
+        :meth:`frame`.
+        """
+        fig, ax = plt.subplots(
+            figsize=self.figsize,
+            dpi=self.dpi,
+            subplot_kw={"projection": lambert_conformal()},
+        )
+        first = self.data.isel({self.time_dim: 0})
+        cs = draw_map(ax, first, self.cmap, self.norm)
+        cbar_ax = fig.add_axes([0.92, 0.15, 0.02, 0.7])
+        plt.colorbar(cs, cax=cbar_ax, label=self.label)
+        self._fig, self._ax, self._cs = fig, ax, cs
+        self._dims = mesh_dims(first)
+        return fig
+
+    def frame(self, n: int) -> bytes:
+        """
+        RGB pixels of frame ``n``.
+        """
+        frame = self.data.isel({self.time_dim: n})
+        self._cs.set_array(frame.transpose(*self._dims).values.ravel())
+        if self.title is not None:
+            self._ax.set_title(
+                self.title.format(time=pd.Timestamp(frame[self.time_dim].values))
+            )
+        self._fig.canvas.draw()
+        return np.asarray(self._fig.canvas.buffer_rgba())[..., :3].tobytes()
+
+    def save(
+        self,
+        path: str,
+        fps: int = 10,
+        max_workers: int | None = None,
+        frames_per_task: int = 8,
+    ):
+        """
+        Encode the animation to ``path`` with ffmpeg.
+
+        Ranges of ``frames_per_task`` frames are rendered in a process pool,
+        each worker drawing one figure and only updating its QuadMesh, and
+        their raw RGB frames are piped in order to a single ffmpeg process.
+        At most two ranges per worker are held in memory.
+        """
+        nframes = len(self)
+        prepare_map(self.data.isel({self.time_dim: 0}), lambert_conformal())
+        width, height = self._size()
+        cmd = [
+            matplotlib.rcParams["animation.ffmpeg_path"],
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-vcodec",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            path,
+        ]
+        ranges = [
+            range(start, min(start + frames_per_task, nframes))
+            for start in range(0, nframes, frames_per_task)
+        ]
+        max_workers = max_workers or min(len(ranges), max(os.cpu_count() - 2, 1))
+        logger.info(f"Rendering {nframes} frames to {path} with {max_workers} workers")
+        ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            # Spawned, not forked: the workers read the data with dask, whose
+            # thread pool and file locks do not survive a fork
+            with ProcessPoolExecutor(
+                max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_animation_worker,
+                initargs=(self,),
+            ) as executor:
+                pending = deque()
+                for frames in ranges:
+                    pending.append(executor.submit(_render_frames, frames))
+                    if len(pending) >= 2 * max_workers:
+                        ffmpeg.stdin.write(pending.popleft().result())
+                while pending:
+                    ffmpeg.stdin.write(pending.popleft().result())
+        finally:
+            ffmpeg.stdin.close()
+            if ffmpeg.wait():
+                raise RuntimeError(f"ffmpeg failed with exit code {ffmpeg.returncode}")
+
+    def _size(self) -> tuple[int, int]:
+        fig = plt.figure(figsize=self.figsize, dpi=self.dpi)
+        size = fig.canvas.get_width_height()
+        plt.close(fig)
+        return size
+
+
+_ANIMATION: Animation | None = None
+
+
+def _init_animation_worker(animation: Animation):
+    global _ANIMATION
+    _init_worker()
+    _ANIMATION = animation
+    _ANIMATION.figure()
+
+
+def _render_frames(frames: range) -> bytes:
+    return b"".join(_ANIMATION.frame(n) for n in frames)
@@ -0,0 +1,16 @@
+import logging
+import sys
+
+from grib_index import split
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+)
+
+if __name__ == "__main__":
+    for var in ["t2mean", "t2max", "t2min", "dewpt2", "precip"]:
+        split(
+            f"{var}_seas5_monthly_2000-2023.grib",
+            f"output/{var}/{var}_seas5_monthly_{{date:%Y%m}}_mem{{number}}.grib",
+        )
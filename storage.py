@@ -0,0 +1,238 @@
+"""
+Chunking and compression of the ingested zarr stores.
+
+Chunk shapes are chosen from the access patterns of the analysis with a
+simple cost model: every touched chunk costs a fixed open time plus the time
+to decompress it.
+"""
+
+import itertools
+import math
+from dataclasses import dataclass, field
+
+import numpy as np
+import xarray as xr
+from numcodecs import BitRound, Blosc
+
+# Rough costs used to compare layouts: opening one chunk and decompressing
+# one byte of it.
+CHUNK_OPEN_SECONDS = 2e-3
+DECOMPRESS_BYTES_PER_SECOND = 500e6
+
+CANDIDATE_CHUNKS = (1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 24, 25, 32, 48, 64, 128)
+
+
+@dataclass
+class Query:
+    """
+    One access pattern of the analysis against a store.
+
+    ``extent`` maps a dimension to the number of indices read along it, or to
+    ``(count, stride)`` for strided selections such as one forecast month
+    across years. Dimensions left out are read in full.
+    """
+
+    extent: dict[str, int | tuple[int, int]] = field(default_factory=dict)
+    weight: float = 1.0
+
+
+# The seasonal analyses: a 3-month season of one initialisation month across
+# the hindcast years, for all members and the full domain.
+SEASONAL_QUERIES = [Query({"forecast": (4, 12), "Times": 3})]
+
+
+def _touched(size: int, chunk: int, extent) -> int:
+    count, stride = extent if isinstance(extent, tuple) else (extent, 1)
+    count = min(count, size)
+    if stride >= chunk:
+        return count
+    return math.ceil(((count - 1) * stride + 1) / chunk)
+
+
+def query_cost(sizes: dict[str, int], chunks: dict[str, int], itemsize, query):
+    nchunks = 1
+    for dim, size in sizes.items():
+        nchunks *= _touched(size, chunks[dim], query.extent.get(dim, size))
+    chunk_bytes = math.prod(chunks.values()) * itemsize
+    return nchunks * (CHUNK_OPEN_SECONDS + chunk_bytes / DECOMPRESS_BYTES_PER_SECOND)
+
+
+def choose_chunks(
+    sizes: dict[str, int],
+    itemsize: int,
+    queries: list[Query],
+    fixed: dict[str, int] | None = None,
+    min_bytes: int = 2**20,
+    max_bytes: int = 64 * 2**20,
+) -> dict[str, int]:
+    """
+    Pick the chunk shape that minimises the estimated cost of ``queries``.
+
+    Chunk sizes in ``fixed`` are kept. Dimensions that every query reads in
+    full are only split when a chunk would otherwise exceed ``max_bytes``.
+    """
+    fixed = fixed or {}
+    candidates = {}
+    for dim, size in sizes.items():
+        if dim in fixed:
+            candidates[dim] = [min(fixed[dim], size)]
+        elif all(dim not in q.extent for q in queries):
+            candidates[dim] = sorted({size, math.ceil(size / 2), math.ceil(size / 4)})
+        else:
+            candidates[dim] = sorted({c for c in CANDIDATE_CHUNKS if c < size} | {size})
+    best, best_cost = None, math.inf
+    fallback, fallback_bytes = None, math.inf
+    for shape in itertools.product(*candidates.values()):
+        chunks = dict(zip(sizes, shape))
+        nbytes = math.prod(shape) * itemsize
+        if nbytes > max_bytes:
+            continue
+        if nbytes < min_bytes:
+            # Small arrays cannot reach min_bytes; keep the largest chunk
+            if fallback is None or nbytes > fallback_bytes:
+                fallback, fallback_bytes = chunks, nbytes
+            continue
+        cost = sum(q.weight * query_cost(sizes, chunks, itemsize, q) for q in queries)
+        if cost < best_cost:
+            best, best_cost = chunks, cost
+    if best is None and fallback is None:
+        raise ValueError(f"No chunk shape of {sizes} fits in {max_bytes} bytes")
+    return best or fallback
+
+
+@dataclass
+class Precision:
+    """
+    Precision at which floating point fields are stored.
+
+    Parameters:
+    - dtype: "float32", "float64", or "int16" packed with ``scale_factor`` and
+      ``add_offset`` over ``valid_range``; values outside it are clipped
+    - keepbits: mantissa bits kept when bit-rounding floats before compression
+    - valid_range: (min, max) of the field, required for "int16"
+    """
+
+    dtype: str = "float32"
+    keepbits: int | None = None
+    valid_range: tuple[float, float] | None = None
+
+    def __post_init__(self):
+        if self.dtype not in ("float32", "float64", "int16"):
+            raise ValueError(f"Unsupported storage dtype {self.dtype}")
+        if self.dtype == "int16" and self.valid_range is None:
+            raise ValueError("int16 storage needs a valid_range")
+        if self.dtype == "int16" and self.keepbits is not None:
+            raise ValueError("keepbits only applies to float storage")
+        mantissa = np.finfo(self.float_dtype).nmant
+        if self.keepbits is not None and not 0 < self.keepbits <= mantissa:
+            raise ValueError(f"keepbits must be in 1..{mantissa} for {self.dtype}")
+
+    @property
+    def float_dtype(self) -> str:
+        return "float32" if self.dtype == "int16" else self.dtype
+
+    def _packing(self) -> tuple[float, float]:
+        lo, hi = self.valid_range
+        # -32768 is kept free for the fill value
+        return (hi - lo) / (2**16 - 2), (hi + lo) / 2
+
+    def error_bound(self) -> dict[str, float]:
+        """
+        Largest error of a stored value: absolute for int16, relative otherwise.
+        """
+        if self.dtype == "int16":
+            return {"absolute": self._packing()[0] / 2}
+        bits = self.keepbits or np.finfo(self.dtype).nmant
+        return {"relative": 2.0 ** -(bits + 1)}
+
+    def apply(self, da: xr.DataArray) -> xr.DataArray:
+        da = da.astype(self.float_dtype)
+        if self.dtype == "int16":
+            da = da.clip(*self.valid_range)
+        if self.keepbits is not None:
+            # Zeroed trailing mantissa bits are left for the compressor to drop
+            codec = BitRound(keepbits=self.keepbits)
+            da = xr.apply_ufunc(
+                lambda x: codec.encode(np.array(x)).view(x.dtype).reshape(x.shape),
+                da,
+                dask="parallelized",
+                output_dtypes=[da.dtype],
+                keep_attrs=True,
+            )
+        return da
+
+    def encoding(self) -> dict:
+        if self.dtype == "int16":
+            scale_factor, add_offset = self._packing()
+            return {
+                "dtype": "int16",
+                "scale_factor": scale_factor,
+                "add_offset": add_offset,
+                "_FillValue": np.int16(-(2**15)),
+            }
+        return {}
+
+    def describe(self) -> dict:
+        return {
+            "dtype": self.dtype,
+            "keepbits": self.keepbits,
+            "valid_range": self.valid_range and list(self.valid_range),
+        }
+
+
+@dataclass
+class StoragePolicy:
+    """
+    Chunking and compression of an ingested store.
+
+    ``chunks`` fixes the chunk size along some dimensions; the remaining ones
+    are chosen with :func:`choose_chunks` from ``queries`` or, without
+    queries, are left whole. With ``precision`` the floating point variables
+    are stored at that :class:`Precision` instead of their computed dtype.
+    """
+
+    chunks: dict[str, int] = field(default_factory=lambda: {"member": 1, "forecast": 1})
+    queries: list[Query] = field(default_factory=list)
+    compressor: Blosc = field(
+        default_factory=lambda: Blosc(cname="zstd", clevel=3, shuffle=Blosc.SHUFFLE)
+    )
+    precision: Precision | None = None
+
+    def _quantized(self, ds: xr.Dataset) -> list[str]:
+        if self.precision is None:
+            return []
+        return [k for k, v in ds.data_vars.items() if v.dtype.kind == "f"]
+
+    def apply(self, ds: xr.Dataset) -> xr.Dataset:
+        """
+        Convert the floating point variables of ``ds`` to the stored precision.
+
+        The error bound of the precision is recorded in their attributes.
+        """
+        ds = ds.copy()
+        for name in self._quantized(ds):
+            attrs = ds[name].attrs | {
+                f"storage_{kind}_error": bound
+                for kind, bound in self.precision.error_bound().items()
+            }
+            ds[name] = self.precision.apply(ds[name]).assign_attrs(attrs)
+        return ds
+
+    def resolve(self, ds: xr.Dataset) -> dict[str, int]:
+        sizes = dict(ds.sizes)
+        if not self.queries:
+            return {dim: self.chunks.get(dim, size) for dim, size in sizes.items()}
+        itemsize = max(v.dtype.itemsize for v in ds.data_vars.values())
+        return choose_chunks(sizes, itemsize, self.queries, fixed=self.chunks)
+
+    def encoding(self, ds: xr.Dataset) -> dict[str, dict]:
+        encoding = {name: {"compressor": self.compressor} for name in ds.data_vars}
+        for name in self._quantized(ds):
+            encoding[name] |= self.precision.encoding()
+        return encoding
+
+    def describe(self) -> dict:
+        return {
+            "compressor": self.compressor.get_config(),
+            "precision": self.precision and self.precision.describe(),
+        }
@@ -0,0 +1,108 @@
+"""
+Run file-producing tasks as a dependency graph on a process pool.
+
+A task is submitted as soon as the tasks producing its dependencies have
+finished, instead of waiting for a whole stage, so the pool stays busy.
+Tasks whose target is up to date are skipped unless a dependency was rerun.
+"""
+
+import logging
+import os
+import typing as t
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Task:
+    """
+    Parameters:
+    - target: file produced by the task, also its name in the graph
+    - func: called as ``func(*args)`` in a worker process
+    - deps: targets of the tasks that must finish first; paths that no task
+      produces are taken as existing inputs
+    - is_current: returns True when ``target`` is up to date
+    - outputs: other files written by the task, which dependents may name in
+      their ``deps``
+    """
+
+    target: str
+    func: t.Callable
+    args: tuple = ()
+    deps: list[str] = field(default_factory=list)
+    is_current: t.Callable[[], bool] | None = None
+    outputs: list[str] = field(default_factory=list)
+
+
+def run_graph(tasks: list[Task], max_workers: int | None = None):
+    """
+    Run ``tasks`` in dependency order, raising if any of them failed.
+
+    Dependents of a failed task are not run.
+    """
+    by_target = {task.target: task for task in tasks}
+    if len(by_target) != len(tasks):
+        raise ValueError("Task targets must be unique")
+    producer = {path: task.target for task in tasks for path in task.outputs}
+    producer.update((target, target) for target in by_target)
+    inputs = {task.target: {producer.get(d, d) for d in task.deps} for task in tasks}
+    waiting = {target: inputs[target] & by_target.keys() for target in by_target}
+    dependents = {target: [] for target in by_target}
+    for target, deps in waiting.items():
+        for dep in deps:
+            dependents[dep].append(target)
+    rerun, skipped, failed = set(), set(), set()
+    max_workers = max_workers or max(os.cpu_count() - 2, 1)
+    logger.info(f"Running {len(tasks)} tasks on {max_workers} workers")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+
+        def start(target):
+            task = by_target[target]
+            if (
+                task.is_current is not None
+                and not rerun.intersection(inputs[target])
+                and task.is_current()
+            ):
+                logger.info(f"Up to date: {target}")
+                skipped.add(target)
+                release(target)
+            else:
+                running[executor.submit(task.func, *task.args)] = target
+
+        def release(target):
+            for child in dependents[target]:
+                waiting[child].discard(target)
+                if not waiting[child] and child not in failed:
+                    start(child)
+
+        def fail(target):
+            failed.add(target)
+            for child in dependents[target]:
+                if child not in failed:
+                    logger.error(f"Not running {child}: {target} failed")
+                    fail(child)
+
+        # Taken before starting: skipping a root can already start its children
+        roots = [target for target, deps in waiting.items() if not deps]
+        for target in roots:
+            start(target)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                target = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"Failed: {target}")
+                    fail(target)
+                else:
+                    rerun.add(target)
+                    release(target)
+    if len(rerun) + len(skipped) + len(failed) < len(tasks):
+        raise ValueError("The task dependencies contain a cycle")
+    if failed:
+        raise RuntimeError(f"{len(failed)} tasks failed or were not run")
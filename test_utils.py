@@ -0,0 +1,41 @@
+import dask.array as da
+import numpy as np
+import pytest
+
+from utils import calculate_colormap_range, quantile_digest
+
+
+def _rank_error(values: np.ndarray, estimate: float, q: float) -> float:
+    """Distance in percentiles between ``q`` and the rank of ``estimate``."""
+    values = np.sort(values)
+    below = np.searchsorted(values, estimate, side="left")
+    above = np.searchsorted(values, estimate, side="right") - 1
+    target = q / 100 * (values.size - 1)
+    if below - 1 <= target <= above + 1:
+        return 0.0
+    return 100 * min(abs(below - target), abs(above - target)) / (values.size - 1)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        # One outlier stretching the range by six orders of magnitude
+        np.append(np.random.default_rng(0).normal(size=10**6), 1e6),
+        # Heavy tail
+        np.random.default_rng(1).lognormal(0, 2, size=10**6),
+    ],
+    ids=["outlier", "lognormal"],
+)
+def test_percentiles_rank_error(values):
+    compression = 1000
+    values = np.random.default_rng(2).permutation(values)
+    digest = quantile_digest(da.from_array(values, chunks=50_000), compression)
+    for q in (1, 2, 50, 98, 99):
+        assert _rank_error(values, digest.percentile(q), q) <= 200 / compression
+
+
+def test_small_inputs_are_exact():
+    assert calculate_colormap_range(np.array([1, np.nan, 3.0])) == pytest.approx(
+        (1.04, 2.96)
+    )
+    assert calculate_colormap_range(np.arange(10)) == pytest.approx((0.18, 8.82))
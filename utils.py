@@ -1,32 +1,182 @@
+import hashlib
+import math
+import os
 import typing as t
+from dataclasses import dataclass, field
+from pathlib import Path
 
+import dask
+import dask.array as da
 import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 import numpy as np
 import xarray as xr
+from dask.delayed import Delayed
 
+GRID_CACHE_DIR = "cache/grids"
+
+
+@dataclass
+class Grid:
+    """
+    Longitudes and latitudes of a horizontal grid, loaded once per process.
+
+    Parameters:
+    - key: fingerprint of the shape and values of lon/lat
+    - meshes: projected cell corners keyed by projection
+    """
+
+    key: str
+    lon: np.ndarray
+    lat: np.ndarray
+    meshes: dict[str, tuple[np.ndarray, np.ndarray]] = field(default_factory=dict)
 
-def get_lon_lat(ar: xr.DataArray):
-    lon_lat = [None, None]
 
-    for i, c in ar.coords.items():
-        if all(x is not None for x in lon_lat):
-            break
-        try:
-            units = c.attrs["units"]
-            if units in ("degree_east", "degrees_east"):
-                lon_lat[0] = c
-                continue
-            elif units in ("degree_north", "degrees_north"):
-                lon_lat[1] = c
-                continue
-        except KeyError:
-            pass
-    lon_lat[0].load()
-    lon_lat[1].load()
+_GRIDS: dict[str, Grid] = {}
+# Grid keys of lazily read lon/lat, by the dask names of the coordinates
+_SOURCES: dict[str, str] = {}
+
+
+def _lon_lat_coords(ar: xr.DataArray | xr.Dataset) -> list[xr.DataArray]:
+    lon_lat = [None, None]
+    for c in ar.coords.values():
+        units = c.attrs.get("units")
+        if units in ("degree_east", "degrees_east") and lon_lat[0] is None:
+            lon_lat[0] = c
+        elif units in ("degree_north", "degrees_north") and lon_lat[1] is None:
+            lon_lat[1] = c
+    if any(c is None for c in lon_lat):
+        raise ValueError("No longitude/latitude coordinates with degree units")
     return lon_lat
 
 
+def _fingerprint(lon: np.ndarray, lat: np.ndarray) -> str:
+    h = hashlib.sha1()
+    for values in (lon, lat):
+        h.update(str(values.shape).encode())
+        h.update(values.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _save(path: Path, **arrays):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def _registered(key: str) -> Grid | None:
+    if key not in _GRIDS:
+        path = Path(GRID_CACHE_DIR, f"{key}.npz")
+        if not path.exists():
+            return None
+        with np.load(path) as f:
+            _GRIDS[key] = Grid(key, f["lon"], f["lat"])
+    return _GRIDS[key]
+
+
+def get_grid(ar: xr.DataArray | xr.Dataset) -> Grid:
+    """
+    The :class:`Grid` of ``ar`` from the registry.
+
+    Lon/lat read lazily from a store are loaded the first time the store is
+    seen by any process: the dask names of the coordinates, which depend on
+    the file and its modification time, are mapped to their grid under
+    ``GRID_CACHE_DIR``.
+    """
+    lon, lat = _lon_lat_coords(ar)
+    source = None
+    if all(isinstance(c.variable._data, da.Array) for c in (lon, lat)):
+        source = hashlib.sha1(f"{lon.data.name} {lat.data.name}".encode()).hexdigest()
+        alias = Path(GRID_CACHE_DIR, "sources", source)
+        key = _SOURCES.get(source)
+        if key is None and alias.exists():
+            key = alias.read_text()
+        if key is not None and (grid := _registered(key)) is not None:
+            _SOURCES[source] = key
+            return grid
+    lon = np.ascontiguousarray(lon.values, dtype="float64")
+    lat = np.ascontiguousarray(lat.values, dtype="float64")
+    key = _fingerprint(lon, lat)
+    grid = _registered(key)
+    if grid is None:
+        grid = _GRIDS[key] = Grid(key, lon, lat)
+        _save(Path(GRID_CACHE_DIR, f"{key}.npz"), lon=lon, lat=lat)
+    if source is not None:
+        _SOURCES[source] = key
+        alias.parent.mkdir(parents=True, exist_ok=True)
+        alias.write_text(key)
+    return grid
+
+
+def get_lon_lat(ar: xr.DataArray):
+    """
+    Longitude and latitude coordinates of ``ar``, identified by their units,
+    with the values of its :class:`Grid`.
+    """
+    grid = get_grid(ar)
+    lon, lat = _lon_lat_coords(ar)
+    return [
+        lon.copy(data=grid.lon.astype(lon.dtype, copy=False)),
+        lat.copy(data=grid.lat.astype(lat.dtype, copy=False)),
+    ]
+
+
+def grid_fingerprint(ds: xr.Dataset | xr.DataArray) -> str:
+    return get_grid(ds).key
+
+
+def mesh_dims(ar: xr.DataArray) -> tuple[str, str]:
+    """
+    Dimensions (y, x) of the meshes of :func:`grid_mesh`.
+    """
+    lon, lat = _lon_lat_coords(ar)
+    if lon.ndim == 2:
+        return lon.dims
+    return lat.dims[0], lon.dims[0]
+
+
+def _corners(c: np.ndarray) -> np.ndarray:
+    """
+    Cell corners of a 2-D grid of centres, extrapolated at the edges like
+    ``pcolormesh(shading="nearest")``.
+    """
+    for axis in (1, 0):
+        half = np.diff(c, axis=axis) / 2
+        first = np.take(c, [0], axis) - np.take(half, [0], axis)
+        last = np.take(c, [-1], axis) + np.take(half, [-1], axis)
+        middle = np.take(c, range(c.shape[axis] - 1), axis) + half
+        c = np.concatenate([first, middle, last], axis=axis)
+    return c
+
+
+def grid_mesh(ar: xr.DataArray, projection) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Cell corners of the grid of ``ar`` projected with the cartopy
+    ``projection``, with the shape of :func:`mesh_dims` plus one.
+
+    Kept with the :class:`Grid` and under ``GRID_CACHE_DIR``.
+    """
+    import cartopy.crs as ccrs
+
+    grid = get_grid(ar)
+    pkey = hashlib.sha1(projection.proj4_init.encode()).hexdigest()[:16]
+    if pkey in grid.meshes:
+        return grid.meshes[pkey]
+    path = Path(GRID_CACHE_DIR, f"{grid.key}_{pkey}.npz")
+    if path.exists():
+        with np.load(path) as f:
+            grid.meshes[pkey] = (f["x"], f["y"])
+        return grid.meshes[pkey]
+    lon, lat = grid.lon, grid.lat
+    if lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    xyz = projection.transform_points(ccrs.PlateCarree(), _corners(lon), _corners(lat))
+    grid.meshes[pkey] = (xyz[..., 0], xyz[..., 1])
+    _save(path, x=xyz[..., 0], y=xyz[..., 1])
+    return grid.meshes[pkey]
+
+
 def load_single_data_variable(dataset: xr.Dataset) -> xr.DataArray:
     data_vars = []
     for var in dataset.data_vars:
@@ -60,33 +210,168 @@ def get_cmap(levels, cmap=plt.get_cmap("viridis"), ncolors=256, extend="both"):
     return cmap, norm
 
 
+@dataclass
+class QuantileDigest:
+    """
+    Mergeable t-digest of finite values: centroids of consecutive values,
+    sorted by ``means``, holding ``weights`` values each. Centroids shrink
+    towards both tails, so percentiles are accurate in rank however the
+    values are spread, e.g. with outliers or heavy tails.
+
+    Parameters:
+    - vmin, vmax: exact extremes of the values
+    """
+
+    means: np.ndarray
+    weights: np.ndarray
+    vmin: float
+    vmax: float
+
+    @classmethod
+    def of(cls, values: np.ndarray, compression: int) -> "QuantileDigest | None":
+        values = np.sort(values[np.isfinite(values)].astype(np.float64, copy=False))
+        if values.size == 0:
+            return None
+        weights = np.ones(values.size)
+        return cls(values, weights, float(values[0]), float(values[-1])).compress(
+            compression
+        )
+
+    def compress(self, compression: int) -> "QuantileDigest":
+        """
+        Merge the consecutive centroids whose centre ranks share a unit of the
+        scale ``compression / (2 pi) * asin(2 q - 1)``, which leaves about
+        ``compression / 2`` centroids.
+        """
+        cumulative = np.cumsum(self.weights)
+        q = (cumulative - self.weights / 2) / cumulative[-1]
+        k = np.floor(compression / (2 * np.pi) * np.arcsin(2 * q - 1))
+        first = np.flatnonzero(np.diff(k, prepend=np.nan))
+        weights = np.add.reduceat(self.weights, first)
+        means = np.add.reduceat(self.means * self.weights, first) / weights
+        return QuantileDigest(means, weights, self.vmin, self.vmax)
+
+    def merge(self, other: "QuantileDigest | None", compression: int):
+        if other is None:
+            return self
+        order = np.argsort(np.concatenate([self.means, other.means]), kind="stable")
+        return QuantileDigest(
+            np.concatenate([self.means, other.means])[order],
+            np.concatenate([self.weights, other.weights])[order],
+            min(self.vmin, other.vmin),
+            max(self.vmax, other.vmax),
+        ).compress(compression)
+
+    def percentile(self, q: float) -> float:
+        # Each centroid sits at the centre of the ranks it holds, and the
+        # extremes at the first and last ranks; single values are exact and
+        # are interpolated between as in np.percentile
+        cumulative = np.cumsum(self.weights)
+        positions = np.concatenate(
+            [[0.5], cumulative - self.weights / 2, [cumulative[-1] - 0.5]]
+        )
+        values = np.concatenate([[self.vmin], self.means, [self.vmax]])
+        rank = q / 100 * (cumulative[-1] - 1)
+        return float(np.interp(rank + 0.5, positions, values))
+
+
+def _merge(compression: int, *digests: QuantileDigest | None) -> QuantileDigest | None:
+    digests = [d for d in digests if d is not None]
+    if not digests:
+        return None
+    merged = digests[0]
+    for d in digests[1:]:
+        merged = merged.merge(d, compression)
+    return merged
+
+
+def _digests(array, compression: int, chunk_size: int = 2**22):
+    """
+    Digests of the chunks of ``array``; delayed for dask arrays so that all
+    of them are computed in one pass.
+    """
+    if isinstance(array, xr.DataArray):
+        array = array.data
+    if isinstance(array, da.Array):
+        blocks = [
+            dask.delayed(QuantileDigest.of)(b.ravel(), compression)
+            for b in array.to_delayed().ravel()
+        ]
+        # Merged pairwise, so that partial digests stay small
+        while len(blocks) > 1:
+            blocks = [
+                dask.delayed(_merge)(compression, *blocks[i : i + 2])
+                for i in range(0, len(blocks), 2)
+            ]
+        return blocks
+    flat = np.asarray(array).reshape(-1)
+    return [
+        QuantileDigest.of(flat[i : i + chunk_size], compression)
+        for i in range(0, flat.size, chunk_size)
+    ]
+
+
+def quantile_digest(
+    arrays: t.Iterable[xr.DataArray | np.ndarray | da.Array] | np.ndarray,
+    compression: int = 1000,
+    compute: bool = True,
+) -> QuantileDigest | Delayed | None:
+    """
+    :class:`QuantileDigest` of the finite values of ``arrays``, built chunk
+    by chunk; None if there are none.
+
+    With ``compute=False`` the dask-backed arrays are not read yet and a
+    delayed digest is returned, e.g. to reduce many variables in one
+    ``dask.compute``.
+    """
+    if isinstance(arrays, (np.ndarray, xr.DataArray, da.Array)):
+        arrays = [arrays]
+    digest, delayed = None, []
+    for arr in arrays:
+        for partial in _digests(arr, compression):
+            if isinstance(partial, Delayed):
+                delayed.append(partial)
+            else:
+                digest = _merge(compression, digest, partial)
+    if not compute:
+        return dask.delayed(_merge)(compression, digest, *delayed)
+    return _merge(compression, digest, *dask.compute(*delayed))
+
+
 def calculate_colormap_range(
-    arrays: t.List[t.Union[xr.DataArray, np.ndarray]],
+    arrays: t.Iterable[xr.DataArray | np.ndarray | da.Array] | np.ndarray,
     low_percentile: float = 2,
     high_percentile: float = 98,
+    compression: int = 1000,
 ) -> t.Tuple[float, float]:
     """
-    Calculate colormap range based on the combined percentiles of multiple xarray DataArrays or numpy ndarrays.
+    Calculate colormap range based on the combined percentiles of multiple
+    xarray DataArrays, numpy ndarrays or dask arrays.
+
+    The percentiles are estimated from a :class:`QuantileDigest` built chunk
+    by chunk, so the arrays are never concatenated and dask-backed arrays
+    are only read once, in parallel. The estimate of percentile ``q`` lies
+    between the exact percentiles ``q -/+ 200 / compression`` (e.g. p1.8 and
+    p2.2 for p2), however far outliers or a heavy tail stretch the values;
+    fewer than about ``compression / 10`` values give ``np.nanpercentile``
+    exactly. Non-finite values are ignored.
 
     Parameters:
-    - arrays: list of xarray.DataArray or numpy.ndarray
+    - arrays: iterable (e.g. a list or generator) of arrays, or a single array
     - low_percentile: lower percentile for the colormap range (default is 2)
     - high_percentile: higher percentile for the colormap range (default is 98)
+    - compression: about twice the number of centroids of the digest, which
+      sets the tolerance
 
     Returns:
     - vmin: minimum value for the colormap range
     - vmax: maximum value for the colormap range
     """
-    # Flatten and concatenate all arrays
-    combined_flat = np.concatenate(
-        [
-            arr.values.flatten() if isinstance(arr, xr.DataArray) else arr.flatten()
-            for arr in arrays
-        ]
-    )
+    digest = quantile_digest(arrays, compression)
+    if digest is None:
+        return np.nan, np.nan
 
-    # Calculate the desired percentiles
-    vmin = np.percentile(combined_flat, low_percentile)
-    vmax = np.percentile(combined_flat, high_percentile)
+    vmin = digest.percentile(low_percentile)
+    vmax = digest.percentile(high_percentile)
 
     return vmin, vmax